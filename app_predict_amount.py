@@ -1,21 +1,24 @@
 import os
 import json
-import tempfile
 import base64
 from io import BytesIO
 from glob import glob
-from typing import List
+from typing import Iterator, List, Tuple
 import zipfile
 
 import streamlit as st
 from PIL import Image
 
-from image_search.query import search_image
-from image_search.query_avg import search_topk, average_amount_sold
+from image_search.query import IMAGE_EXTS, search_pil_image
+from image_search.query_avg import average_amount_sold
 
 INDEX_DIR = "/Users/yairhazan/Downloads/archive/vector_index_cleaned"
 MODEL = "clip-ViT-B-32"
 DEVICE = "cpu"
+# Limits for uploaded .zip archives (checked against the central directory before decoding)
+MAX_ZIP_MEMBERS = 2000
+MAX_ZIP_MEMBER_BYTES = 50 * 1024 * 1024
+MAX_ZIP_TOTAL_BYTES = 1024 * 1024 * 1024
 
 st.set_page_config(page_title="Predict Amount", page_icon="🛍️", layout="wide")
 
@@ -26,6 +29,9 @@ with st.sidebar:
     st.header("Settings")
     top_k = st.slider("Top K", min_value=1, max_value=20, value=5)
     mode = st.radio("Mode", options=["Similar Items", "Average Amount Sold", "Batch Folder Report"], index=0)
+    alpha = None
+    if st.checkbox("Override image/text weight", value=False):
+        alpha = st.slider("Image weight (alpha)", min_value=0.0, max_value=1.0, value=0.7, step=0.05)
 
 uploaded = None
 batch_files: List = []
@@ -63,104 +69,116 @@ def _path_img_to_data_uri(path: str) -> str:
     except Exception:
         return ""
 
-if run and mode != "Batch Folder Report" and uploaded is not None:
-    with st.spinner("Searching..."):
-        # Save to temp file for existing pipeline functions
-        with tempfile.NamedTemporaryFile(suffix=".jpg", delete=False) as tmp:
-            tmp_path = tmp.name
-            Image.open(uploaded).convert("RGB").save(tmp_path, format="JPEG")
-        try:
-            if mode == "Similar Items":
-                hits = search_image(tmp_path, INDEX_DIR, top_k=top_k, model_name=MODEL, device=DEVICE)
-                with col2:
-                    st.subheader("Similar Items")
-                    for h in hits:
-                        cols = st.columns([1, 3])
-                        with cols[0]:
-                            st.image(h.get("image_path"), use_column_width=True)
-                        with cols[1]:
-                            st.markdown(f"**Score:** {h.get('score'):.3f}")
-                            title = h.get("name") or h.get("id")
-                            if h.get("link"):
-                                st.markdown(f"**Item:** [{title}]({h.get('link')})")
-                            else:
-                                st.markdown(f"**Item:** {title}")
-                            if h.get("price"):
-                                st.markdown(f"**Price:** {h.get('price')}")
-                            if h.get("details"):
-                                st.caption(h.get("details"))
-            else:
-                hits = search_topk(tmp_path, INDEX_DIR, top_k=top_k, model_name=MODEL, device=DEVICE)
-                avg = average_amount_sold(hits)
-                with col2:
-                    st.subheader("Average Amount Sold")
-                    st.metric(label=f"Average over top {top_k}", value=f"{avg:.1f}")
-                    st.divider()
-                    st.subheader("Top Matches")
-                    for h in hits:
-                        cols = st.columns([1, 3])
-                        with cols[0]:
-                            st.image(h.get("image_path"), use_column_width=True)
-                        with cols[1]:
-                            st.markdown(f"**Score:** {h.get('score'):.3f}")
-                            title = h.get("name") or h.get("id")
-                            if h.get("link"):
-                                st.markdown(f"**Item:** [{title}]({h.get('link')})")
-                            else:
-                                st.markdown(f"**Item:** {title}")
-                            st.markdown(f"**Amount sold:** {h.get('amount_sold', 'N/A')}")
-                            if h.get("price"):
-                                st.markdown(f"**Price:** {h.get('price')}")
-                            if h.get("details"):
-                                st.caption(h.get("details"))
-        finally:
+
+def _zip_image_members(zf: zipfile.ZipFile) -> List[zipfile.ZipInfo]:
+    members = [
+        info for info in zf.infolist()
+        if not info.is_dir()
+        and info.filename.lower().endswith(IMAGE_EXTS)
+        and not os.path.basename(info.filename).startswith(".")
+    ]
+    if len(members) > MAX_ZIP_MEMBERS:
+        raise ValueError(f"archive has {len(members)} images; the limit is {MAX_ZIP_MEMBERS}")
+    total = 0
+    for info in members:
+        if info.file_size > MAX_ZIP_MEMBER_BYTES:
+            raise ValueError(f"{info.filename} is {info.file_size} bytes uncompressed; the limit is {MAX_ZIP_MEMBER_BYTES}")
+        total += info.file_size
+    if total > MAX_ZIP_TOTAL_BYTES:
+        raise ValueError(f"archive expands to {total} bytes; the limit is {MAX_ZIP_TOTAL_BYTES}")
+    return members
+
+
+def _iter_batch_images(files: List) -> Iterator[Tuple[str, Image.Image]]:
+    # Yields one decoded image at a time so memory stays bounded by a single member
+    for uf in files:
+        name = uf.name.lower()
+        if name.endswith(IMAGE_EXTS):
             try:
-                os.remove(tmp_path)
+                yield uf.name, Image.open(uf).convert("RGB")
             except Exception:
-                pass
+                continue
+        elif name.endswith(".zip"):
+            with zipfile.ZipFile(uf) as zf:
+                for info in _zip_image_members(zf):
+                    try:
+                        with zf.open(info) as member:
+                            # ZipExtFile stops at the declared size, so this read is bounded
+                            data = member.read(MAX_ZIP_MEMBER_BYTES + 1)
+                        qimg = Image.open(BytesIO(data)).convert("RGB")
+                    except Exception:
+                        continue
+                    yield os.path.basename(info.filename), qimg
+
+if run and mode != "Batch Folder Report" and uploaded is not None:
+    with st.spinner("Searching..."):
+        # Searched in memory: the upload has no durable path, so the query log
+        # stores it under IMAGE_SEARCH_QUERY_LOG_INPUTS when that is set
+        with Image.open(uploaded) as raw:
+            qimg = raw.convert("RGB")
+        if mode == "Similar Items":
+            hits = search_pil_image(qimg, INDEX_DIR, top_k=top_k, model_name=MODEL, device=DEVICE, alpha=alpha)
+            with col2:
+                st.subheader("Similar Items")
+                for h in hits:
+                    cols = st.columns([1, 3])
+                    with cols[0]:
+                        st.image(h.get("image_path"), use_column_width=True)
+                    with cols[1]:
+                        st.markdown(f"**Score:** {h.get('score'):.3f}")
+                        title = h.get("name") or h.get("id")
+                        if h.get("link"):
+                            st.markdown(f"**Item:** [{title}]({h.get('link')})")
+                        else:
+                            st.markdown(f"**Item:** {title}")
+                        if h.get("price"):
+                            st.markdown(f"**Price:** {h.get('price')}")
+                        if h.get("details"):
+                            st.caption(h.get("details"))
+                        if len(h.get("ids") or []) > 1:
+                            st.caption("Also listed as: " + ", ".join(h["ids"][1:]))
+        else:
+            hits = search_pil_image(qimg, INDEX_DIR, top_k=top_k, model_name=MODEL, device=DEVICE, alpha=alpha, op="search_topk")
+            avg = average_amount_sold(hits)
+            with col2:
+                st.subheader("Average Amount Sold")
+                st.metric(label=f"Average over top {top_k}", value=f"{avg:.1f}")
+                st.divider()
+                st.subheader("Top Matches")
+                for h in hits:
+                    cols = st.columns([1, 3])
+                    with cols[0]:
+                        st.image(h.get("image_path"), use_column_width=True)
+                    with cols[1]:
+                        st.markdown(f"**Score:** {h.get('score'):.3f}")
+                        title = h.get("name") or h.get("id")
+                        if h.get("link"):
+                            st.markdown(f"**Item:** [{title}]({h.get('link')})")
+                        else:
+                            st.markdown(f"**Item:** {title}")
+                        st.markdown(f"**Amount sold:** {h.get('amount_sold', 'N/A')}")
+                        if h.get("price"):
+                            st.markdown(f"**Price:** {h.get('price')}")
+                        if h.get("details"):
+                            st.caption(h.get("details"))
 elif run and mode == "Batch Folder Report":
     if not batch_files:
         st.warning("Please select images or a .zip file.")
     else:
         with st.spinner("Generating folder report..."):
-            temp_paths: List[str] = []
-            extract_dirs: List[str] = []
             try:
-                # Save images and expand zips
+                # Check zip limits up front so a bad archive fails before any work
                 for uf in batch_files:
-                    name = uf.name.lower()
-                    if name.endswith((".jpg", ".jpeg", ".png", ".webp")):
-                        with tempfile.NamedTemporaryFile(suffix=os.path.splitext(name)[1], delete=False) as tmp:
-                            tmp.write(uf.read())
-                            temp_paths.append(tmp.name)
-                    elif name.endswith(".zip"):
-                        # Persist uploaded zip then extract to a temp dir
-                        with tempfile.NamedTemporaryFile(suffix=".zip", delete=False) as ztmp:
-                            ztmp.write(uf.read())
-                            zpath = ztmp.name
-                        real_dir = tempfile.mkdtemp(prefix="batch_zip_")
-                        extract_dirs.append(real_dir)
-                        try:
-                            with zipfile.ZipFile(zpath) as zf:
-                                zf.extractall(real_dir)
-                        finally:
-                            try:
-                                os.remove(zpath)
-                            except Exception:
-                                pass
-                        # Walk extracted dir for images
-                        for root, _, files in os.walk(real_dir):
-                            for fn in files:
-                                if fn.lower().endswith((".jpg", ".jpeg", ".png", ".webp")):
-                                    temp_paths.append(os.path.join(root, fn))
-
-                files = temp_paths
-                if not files:
-                    st.warning("No images found in the selected files.")
-                else:
-                    sections: List[str] = []
-                    sections.append(
-                        """
+                    if uf.name.lower().endswith(".zip"):
+                        with zipfile.ZipFile(uf) as zf:
+                            _zip_image_members(zf)
+                        uf.seek(0)
+            except (ValueError, zipfile.BadZipFile) as e:
+                st.error(f"Cannot process {uf.name}: {e}")
+            else:
+                sections: List[str] = []
+                sections.append(
+                    """
 <!DOCTYPE html>
 <html lang=\"en\">\n<head>\n<meta charset=\"utf-8\" />\n<title>Predict Amount - Folder Report</title>\n<style>
 body{font-family:system-ui,-apple-system,Segoe UI,Roboto,Inter,Helvetica,Arial,sans-serif; margin:24px;}
@@ -176,50 +194,40 @@ body{font-family:system-ui,-apple-system,Segoe UI,Roboto,Inter,Helvetica,Arial,s
 h1{margin:0 0 4px} h2{margin:0} .small{color:#64748b;font-size:12px}
 </style>\n</head>\n<body>\n<h1>Predict Amount - Folder Report</h1>\n<p class=\"small\">Top {top_k} similar items per query image. Generated on this machine.</p>
 """
-                    )
-
-                    for i, fpath in enumerate(files, start=1):
-                        try:
-                            qimg = Image.open(fpath).convert("RGB")
-                        except Exception:
-                            continue
-                        data_uri = _img_to_data_uri(qimg)
-                        # Save temp for pipeline
-                        with tempfile.NamedTemporaryFile(suffix=".jpg", delete=False) as tmp:
-                            qimg.save(tmp.name, format="JPEG")
-                            tmp_query = tmp.name
-                        try:
-                            hits = search_image(tmp_query, INDEX_DIR, top_k=top_k, model_name=MODEL, device=DEVICE)
-                        finally:
-                            try:
-                                os.remove(tmp_query)
-                            except Exception:
-                                pass
-
-                        # Build section HTML
-                        title = os.path.basename(fpath)
-                        html = ["<section class=\"q\">"]
-                        html.append(f"<img class=\"qimg\" src=\"{data_uri}\" alt=\"{title}\" />")
-                        html.append("<div class=\"qmeta\">")
-                        html.append(f"<h2>{title}</h2>")
-                        html.append("<div class=\"grid\">")
-                        for h in hits:
-                            sim_uri = _path_img_to_data_uri(h.get("image_path", ""))
-                            item_name = (h.get("name") or h.get("id") or "").replace("<","&lt;").replace(">","&gt;")
-                            details = (h.get("details") or "").replace("<","&lt;").replace(">","&gt;")
-                            score = h.get("score")
-                            html.append("<div class=\"card\">")
-                            if sim_uri:
-                                html.append(f"<img class=\"cimg\" src=\"{sim_uri}\" alt=\"{item_name}\" />")
-                            html.append(f"<div class=\"title\">{item_name}</div>")
-                            if details:
-                                html.append(f"<p class=\"sub\">{details}</p>")
-                            if isinstance(score, (int, float)):
-                                html.append(f"<div class=\"score\">Score: {score:.3f}</div>")
-                            html.append("</div>")
-                        html.append("</div></div></section>")
-                        sections.append("\n".join(html))
-
+                )
+
+                n_queries = 0
+                for title, qimg in _iter_batch_images(batch_files):
+                    n_queries += 1
+                    data_uri = _img_to_data_uri(qimg)
+                    hits = search_pil_image(qimg, INDEX_DIR, top_k=top_k, model_name=MODEL, device=DEVICE, alpha=alpha)
+
+                    # Build section HTML
+                    html = ["<section class=\"q\">"]
+                    html.append(f"<img class=\"qimg\" src=\"{data_uri}\" alt=\"{title}\" />")
+                    html.append("<div class=\"qmeta\">")
+                    html.append(f"<h2>{title}</h2>")
+                    html.append("<div class=\"grid\">")
+                    for h in hits:
+                        sim_uri = _path_img_to_data_uri(h.get("image_path", ""))
+                        item_name = (h.get("name") or h.get("id") or "").replace("<","&lt;").replace(">","&gt;")
+                        details = (h.get("details") or "").replace("<","&lt;").replace(">","&gt;")
+                        score = h.get("score")
+                        html.append("<div class=\"card\">")
+                        if sim_uri:
+                            html.append(f"<img class=\"cimg\" src=\"{sim_uri}\" alt=\"{item_name}\" />")
+                        html.append(f"<div class=\"title\">{item_name}</div>")
+                        if details:
+                            html.append(f"<p class=\"sub\">{details}</p>")
+                        if isinstance(score, (int, float)):
+                            html.append(f"<div class=\"score\">Score: {score:.3f}</div>")
+                        html.append("</div>")
+                    html.append("</div></div></section>")
+                    sections.append("\n".join(html))
+
+                if not n_queries:
+                    st.warning("No images found in the selected files.")
+                else:
                     sections.append("</body>\n</html>")
                     report_html = "\n".join(sections)
 
@@ -231,24 +239,6 @@ h1{margin:0 0 4px} h2{margin:0} .small{color:#64748b;font-size:12px}
                         file_name="predict_amount_report.html",
                         mime="text/html",
                     )
-            finally:
-                # Cleanup extracted directories
-                for d in extract_dirs:
-                    try:
-                        for root, dirs, files in os.walk(d, topdown=False):
-                            for fn in files:
-                                try:
-                                    os.remove(os.path.join(root, fn))
-                                except Exception:
-                                    pass
-                            for dd in dirs:
-                                try:
-                                    os.rmdir(os.path.join(root, dd))
-                                except Exception:
-                                    pass
-                        os.rmdir(d)
-                    except Exception:
-                        pass
 else:
     with col2:
         if mode == "Batch Folder Report":
@@ -4,6 +4,9 @@ import random
 import hashlib
 from typing import List, Dict
 
+from image_search.index_store import clone_version, is_store, publish_index, read_meta, write_meta
+from image_search.shards import is_sharded, load_shard_map
+
 META_PATH = "/Users/yairhazan/Downloads/archive/vector_index/image_meta.json"
 
 
@@ -14,17 +17,53 @@ def deterministic_amount_sold(item_id: str) -> int:
     return n % 2001
 
 
+def _fill_amount_sold(meta: List[Dict]) -> bool:
+    changed = False
+    for rec in meta:
+        # Collapsed duplicate rows carry per-product members that need the field too
+        for r in [rec] + rec.get("members", []):
+            if "amount_sold" not in r:
+                r["amount_sold"] = deterministic_amount_sold(r.get("id", ""))
+                changed = True
+    return changed
+
+
 def add_amount_sold(meta_path: str = META_PATH) -> None:
+    # Accepts a legacy image_meta.json, a memory-mapped index directory or a
+    # sharded one
+    if os.path.isdir(meta_path) and is_sharded(meta_path):
+        updated = {}
+        for name, shard_dir in load_shard_map(meta_path):
+            meta = read_meta(shard_dir)
+            if _fill_amount_sold(meta):
+                updated[name] = meta
+        if not updated:
+            print("No changes; amount_sold already present")
+            return
+        # Every shard's metadata changes together in one published version
+        version_dir = clone_version(meta_path)
+        for name, shard_dir in load_shard_map(version_dir):
+            if name in updated:
+                write_meta(shard_dir, updated[name])
+        publish_index(version_dir, meta_path)
+        print(f"Published {meta_path} with amount_sold")
+        return
+    if os.path.isdir(meta_path) and is_store(meta_path):
+        meta = read_meta(meta_path)
+        if not _fill_amount_sold(meta):
+            print("No changes; amount_sold already present")
+            return
+        # Published as a new version so serving processes never see a half-written file
+        version_dir = clone_version(meta_path)
+        write_meta(version_dir, meta)
+        publish_index(version_dir, meta_path)
+        print(f"Published {meta_path} with amount_sold")
+        return
     if not os.path.exists(meta_path):
         raise FileNotFoundError(meta_path)
     with open(meta_path, "r") as f:
-        meta: List[Dict] = json.load(f)
-    changed = False
-    for rec in meta:
-        if "amount_sold" not in rec:
-            rec["amount_sold"] = deterministic_amount_sold(rec.get("id", ""))
-            changed = True
-    if changed:
+        meta = json.load(f)
+    if _fill_amount_sold(meta):
         with open(meta_path, "w") as f:
             json.dump(meta, f)
         print(f"Updated {meta_path} with amount_sold")
@@ -33,4 +72,6 @@ def add_amount_sold(meta_path: str = META_PATH) -> None:
 
 
 if __name__ == "__main__":
-    add_amount_sold()
+    import sys
+
+    add_amount_sold(*sys.argv[1:2])
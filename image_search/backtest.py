@@ -0,0 +1,256 @@
+import csv
+import json
+import os
+import time
+from typing import List, Optional, Sequence, Tuple
+
+from image_search.runtime import configure_threads
+
+configure_threads("batch")
+
+import numpy as np
+
+from image_search.index_store import is_store, read_meta, topk_inner_product
+from image_search.shards import is_sharded, load_shard_map
+
+# Leave-one-product-out backtest of the query_avg predictor. Every catalog row is
+# used as a query with its stored image vector, the whole catalog is searched
+# once per fusion weight at the largest k, and every (k, weighting) pair is then
+# scored with cumulative sums over the neighbour matrix. As in
+# average_amount_sold, a collapsed neighbour row contributes every member
+# product, and a collapsed query row is scored once per member product.
+
+WEIGHTINGS = ("uniform", "score", "rank", "softmax")
+
+
+def _load_dir(index_dir: str) -> Tuple[np.ndarray, Optional[np.ndarray], Optional[np.ndarray], List[dict]]:
+    X_fused = np.load(os.path.join(index_dir, "vectors.npy"), mmap_mode="r")
+    img_path = os.path.join(index_dir, "image_vectors.npy")
+    txt_path = os.path.join(index_dir, "text_vectors.npy")
+    X_img = np.load(img_path, mmap_mode="r") if os.path.exists(img_path) else None
+    X_txt = np.load(txt_path, mmap_mode="r") if os.path.exists(txt_path) else None
+    return X_fused, X_img, X_txt, read_meta(index_dir)
+
+
+def load_catalog(index_dir: str) -> Tuple[np.ndarray, Optional[np.ndarray], Optional[np.ndarray], List[dict]]:
+    # Shards are concatenated back into one catalog
+    if is_sharded(index_dir):
+        parts = [_load_dir(d) for _, d in load_shard_map(index_dir)]
+        X_fused = np.concatenate([p[0] for p in parts])
+        X_img = None if any(p[1] is None for p in parts) else np.concatenate([p[1] for p in parts])
+        X_txt = None if any(p[2] is None for p in parts) else np.concatenate([p[2] for p in parts])
+        meta = [row for p in parts for row in p[3]]
+        return X_fused, X_img, X_txt, meta
+    if is_store(index_dir):
+        return _load_dir(index_dir)
+    raise FileNotFoundError("Backtesting needs an index built by build_index (vectors.npy/meta.jsonl).")
+
+
+def _fused(X_img: np.ndarray, X_txt: np.ndarray, alpha: float) -> np.ndarray:
+    X = alpha * np.asarray(X_img, dtype="float32") + (1.0 - alpha) * np.asarray(X_txt, dtype="float32")
+    return (X / (np.linalg.norm(X, axis=1, keepdims=True) + 1e-12)).astype("float32")
+
+
+def neighbours(Q: np.ndarray, X: np.ndarray, groups: np.ndarray, k: int, query_block: int = 1024) -> Tuple[np.ndarray, np.ndarray]:
+    # Top-k rows for every query row, excluding rows of the same product
+    n = Q.shape[0]
+    extra = int(np.bincount(groups).max())
+    scores = np.empty((n, k), dtype="float32")
+    idxs = np.empty((n, k), dtype="int64")
+    for start in range(0, n, query_block):
+        s, i = topk_inner_product(Q[start:start + query_block], X, k + extra)
+        own = (i >= 0) & (groups[np.maximum(i, 0)] == groups[start:start + s.shape[0], None])
+        s = np.where(own | (i < 0), -np.inf, s)
+        # Stable sort keeps the search order and pushes excluded entries to the end
+        order = np.argsort(-s, axis=1, kind="stable")[:, :k]
+        scores[start:start + s.shape[0]] = np.take_along_axis(s, order, axis=1)
+        idxs[start:start + s.shape[0]] = np.where(
+            np.isfinite(np.take_along_axis(s, order, axis=1)), np.take_along_axis(i, order, axis=1), -1
+        )
+    return scores, idxs
+
+
+def product_groups(meta: List[dict]) -> np.ndarray:
+    # Leave-one-product-out groups: a collapsed row stands for every product in its
+    # ids, so rows sharing any product id (directly or through another row) form
+    # one group and never predict each other
+    parent = list(range(len(meta)))
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    first_row = {}
+    for i, r in enumerate(meta):
+        for pid in r.get("ids") or [r["id"]]:
+            j = first_row.setdefault(pid, i)
+            ri, rj = find(i), find(j)
+            if ri != rj:
+                parent[max(ri, rj)] = min(ri, rj)
+    _, groups = np.unique([find(i) for i in range(len(meta))], return_inverse=True)
+    return groups
+
+
+def _amount(rec: dict) -> float:
+    v = rec.get("amount_sold")
+    return float(v) if isinstance(v, (int, float)) else np.nan
+
+
+def row_amounts(meta: List[dict]) -> Tuple[np.ndarray, np.ndarray]:
+    # Sum and count of amount_sold over the products behind each row
+    sums = np.zeros(len(meta), dtype="float64")
+    counts = np.zeros(len(meta), dtype="float64")
+    for i, r in enumerate(meta):
+        vals = [_amount(m) for m in r.get("members") or [r]]
+        vals = [v for v in vals if not np.isnan(v)]
+        sums[i] = sum(vals)
+        counts[i] = len(vals)
+    return sums, counts
+
+
+def product_targets(meta: List[dict]) -> Tuple[np.ndarray, np.ndarray, List[str]]:
+    # One target per product with amount_sold: its row, value and category key
+    rows: List[int] = []
+    y: List[float] = []
+    cat_keys: List[str] = []
+    for i, r in enumerate(meta):
+        for m in r.get("members") or [r]:
+            v = _amount(m)
+            if np.isnan(v):
+                continue
+            rows.append(i)
+            y.append(v)
+            cat_keys.append(f"{m.get('gender') or ''}:{m.get('category') or ''}")
+    return np.array(rows, dtype="int64"), np.array(y, dtype="float64"), cat_keys
+
+
+def _weights(scores: np.ndarray, scheme: str, temperature: float) -> np.ndarray:
+    if scheme == "uniform":
+        return np.ones_like(scores)
+    if scheme == "score":
+        return np.clip(scores, 0.0, None)
+    if scheme == "rank":
+        return np.broadcast_to(1.0 / np.arange(1, scores.shape[1] + 1, dtype="float32"), scores.shape)
+    if scheme == "softmax":
+        finite = np.where(np.isfinite(scores), scores, -np.inf)
+        return np.exp((finite - finite[:, :1]) / temperature)
+    raise ValueError(f"Unknown weighting: {scheme}")
+
+
+def score_predictions(
+    scores: np.ndarray,
+    idxs: np.ndarray,
+    row_sums: np.ndarray,
+    row_counts: np.ndarray,
+    target_rows: np.ndarray,
+    y: np.ndarray,
+    categories: np.ndarray,
+    category_names: Sequence[str],
+    ks: Sequence[int],
+    weightings: Sequence[str] = WEIGHTINGS,
+    temperature: float = 0.05,
+) -> List[dict]:
+    # A neighbour row's weight applies to each of its products, so the prediction is
+    # sum(w * row_sum) / sum(w * row_count); rows without amount_sold are skipped
+    # like average_amount_sold does. Targets are per product (target_rows, y).
+    valid = idxs >= 0
+    S = np.where(valid, row_sums[np.maximum(idxs, 0)], 0.0)
+    C = np.where(valid, row_counts[np.maximum(idxs, 0)], 0.0)
+    rows: List[dict] = []
+    for scheme in weightings:
+        W = np.where(valid & (C > 0), _weights(scores, scheme, temperature), 0.0)
+        num = np.cumsum(W * S, axis=1)
+        den = np.cumsum(W * C, axis=1)
+        for k in ks:
+            with np.errstate(invalid="ignore", divide="ignore"):
+                pred = np.where(den[:, k - 1] > 0, num[:, k - 1] / den[:, k - 1], 0.0)
+            err = np.abs(pred[target_rows] - y)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                ape = np.where(y > 0, err / y, np.nan)
+            for c, name in enumerate(list(category_names) + ["ALL"]):
+                sel = np.ones(len(y), dtype=bool) if name == "ALL" else categories == c
+                n = int(sel.sum())
+                if not n:
+                    continue
+                ape_sel = ape[sel]
+                ape_sel = ape_sel[~np.isnan(ape_sel)]
+                rows.append({
+                    "weighting": scheme,
+                    "k": int(k),
+                    "category": name,
+                    "n": n,
+                    "mae": float(err[sel].mean()),
+                    "mape": float(ape_sel.mean()) if ape_sel.size else float("nan"),
+                })
+    return rows
+
+
+def backtest(
+    index_dir: str,
+    ks: Sequence[int] = (1, 3, 5, 10, 20),
+    alphas: Sequence[Optional[float]] = (None,),
+    weightings: Sequence[str] = WEIGHTINGS,
+    temperature: float = 0.05,
+) -> List[dict]:
+    X_fused, X_img, X_txt, meta = load_catalog(index_dir)
+    row_sums, row_counts = row_amounts(meta)
+    target_rows, y, cat_keys = product_targets(meta)
+    if not len(y):
+        raise RuntimeError("No amount_sold in index metadata; run add_amount_sold first")
+    groups = product_groups(meta)
+    category_names, categories = np.unique(cat_keys, return_inverse=True)
+
+    Q = np.ascontiguousarray(X_img if X_img is not None else X_fused, dtype="float32")
+    k_max = max(ks)
+    rows: List[dict] = []
+    for alpha in alphas:
+        if alpha is None or X_txt is None:
+            X = np.asarray(X_fused, dtype="float32")
+        else:
+            X = _fused(X_img, X_txt, float(alpha))
+        scores, idxs = neighbours(Q, X, groups, k_max)
+        for r in score_predictions(
+            scores, idxs, row_sums, row_counts, target_rows, y, categories, category_names, ks, weightings, temperature
+        ):
+            rows.append({"alpha": "build" if alpha is None else float(alpha), **r})
+    return rows
+
+
+def _parse_alphas(text: str) -> List[Optional[float]]:
+    return [None if a.strip().lower() in ("", "none", "build") else float(a) for a in text.split(",")]
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Leave-one-product-out backtest of average amount_sold over top-k neighbours")
+    parser.add_argument("--index_dir", default="vector_index")
+    parser.add_argument("--ks", default="1,3,5,10,20", help="Comma-separated k values")
+    parser.add_argument("--alphas", default="build", help="Comma-separated image weights; 'build' uses the stored fused vectors")
+    parser.add_argument("--weightings", default=",".join(WEIGHTINGS))
+    parser.add_argument("--temperature", type=float, default=0.05, help="Softmax temperature over similarity scores")
+    parser.add_argument("--out", default=None, help="Write all rows to this CSV")
+    args = parser.parse_args()
+
+    t0 = time.perf_counter()
+    rows = backtest(
+        args.index_dir,
+        ks=[int(k) for k in args.ks.split(",")],
+        alphas=_parse_alphas(args.alphas),
+        weightings=[w.strip() for w in args.weightings.split(",")],
+        temperature=args.temperature,
+    )
+    elapsed = time.perf_counter() - t0
+
+    if args.out:
+        with open(args.out, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+            writer.writeheader()
+            writer.writerows(rows)
+    overall = sorted((r for r in rows if r["category"] == "ALL"), key=lambda r: r["mae"])
+    for r in overall:
+        print(json.dumps(r))
+    best = overall[0]
+    print(f"Best: alpha={best['alpha']} k={best['k']} weighting={best['weighting']} MAE={best['mae']:.1f} MAPE={best['mape']:.3f} ({elapsed:.1f}s)")
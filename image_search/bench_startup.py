@@ -0,0 +1,70 @@
+import os
+import statistics
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional
+
+
+def _time_run(cmd: List[str], env: Dict[str, str], expect_error: bool = False) -> float:
+    t0 = time.perf_counter()
+    # The expected usage message is not echoed; real failures still show on stderr
+    proc = subprocess.run(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL if expect_error else None)
+    elapsed = time.perf_counter() - t0
+    if (proc.returncode != 0) != expect_error:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+    return elapsed
+
+
+def bench_startup(
+    image: Optional[str],
+    index_dir: str,
+    runs: int = 5,
+    top_k: int = 5,
+    model_name: str = "clip-ViT-B-32",
+) -> Dict[str, float]:
+    # --help and argument errors never load torch or faiss, so they are timed even
+    # where those are not installed; without an image only they are measured
+    env = {k: v for k, v in os.environ.items() if k != "IMAGE_SEARCH_WORKER"}
+    base = [sys.executable, "-m", "image_search.query_avg"]
+    interpreter_times = [_time_run([sys.executable, "-c", "pass"], env) for _ in range(runs)]
+    help_times = [_time_run(base + ["--help"], env) for _ in range(runs)]
+    # --image is required, so this exits with a usage error
+    arg_error_times = [_time_run(base + ["--top_k", "5"], env, expect_error=True) for _ in range(runs)]
+    res = {
+        "interpreter_median_s": statistics.median(interpreter_times),
+        "help_median_s": statistics.median(help_times),
+        "arg_error_median_s": statistics.median(arg_error_times),
+    }
+    if image is None:
+        return res
+
+    query = base + ["--image", image, "--index_dir", index_dir, "--top_k", str(top_k), "--model", model_name, "--only_avg"]
+    cold_times = [_time_run(query, env) for _ in range(runs)]
+    # First worker call starts the worker and loads the model; it is reported separately
+    first_worker = _time_run(query + ["--worker"], env)
+    warm_times = [_time_run(query + ["--worker"], env) for _ in range(runs)]
+    return {
+        **res,
+        "cold_median_s": statistics.median(cold_times),
+        "worker_first_call_s": first_worker,
+        "warm_median_s": statistics.median(warm_times),
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Compare cold CLI startup against worker-backed (warm) invocations")
+    parser.add_argument("--image", default=None, help="Query image; without it only --help and argument-error startup are timed")
+    parser.add_argument("--index_dir", default="vector_index")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top_k", type=int, default=5)
+    parser.add_argument("--model", default="clip-ViT-B-32")
+    args = parser.parse_args()
+
+    res = bench_startup(args.image, args.index_dir, runs=args.runs, top_k=args.top_k, model_name=args.model)
+    for k, v in res.items():
+        print(f"{k:>22}: {v:.3f}")
+    if "warm_median_s" in res:
+        print(f"{'cold/warm speedup':>22}: {res['cold_median_s'] / max(res['warm_median_s'], 1e-9):.1f}x")
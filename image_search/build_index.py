@@ -1,18 +1,33 @@
 import os
-# Constrain thread counts to avoid segfaults on macOS/Python 3.13
-os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
-os.environ.setdefault("OMP_NUM_THREADS", "1")
-os.environ.setdefault("MKL_NUM_THREADS", "1")
+
+# Thread budgets must be in the environment before numpy/torch/faiss load
+from image_search.runtime import apply_threads, configure_threads, peak_rss_mb
+
+configure_threads("build")
 
 import json
+import shutil
 from typing import Dict, List, Tuple, Optional
 
-import faiss  # type: ignore
 import numpy as np
 from PIL import Image
 from sentence_transformers import SentenceTransformer
 from tqdm import tqdm
 
+from image_search.cascade import encode_cascade
+from image_search.index_store import (
+    CASCADE_FILE,
+    VECTORS_FILE,
+    create_vectors,
+    new_version_dir,
+    publish_index,
+    release_pages,
+    write_store,
+)
+from image_search.shards import SHARD_BY, partition_rows, write_shard_map
+
+apply_threads()
+
 
 def load_manifest(manifest_path: str) -> List[Tuple[str, str]]:
     pairs: List[Tuple[str, str]] = []
@@ -44,6 +59,83 @@ def _normalize(v: np.ndarray) -> np.ndarray:
     return (v / norms).astype("float32")
 
 
+def _dhash(img: Image.Image, size: int = 8) -> int:
+    # Difference hash: sign of horizontal gradients on a tiny grayscale thumbnail
+    px = np.asarray(img.convert("L").resize((size + 1, size), Image.BILINEAR), dtype=np.int16)
+    bits = np.packbits((px[:, 1:] > px[:, :-1]).flatten())
+    return int.from_bytes(bits.tobytes(), "big")
+
+
+def _duplicate_groups(
+    blob_hashes: List[Optional[int]],
+    blob_of_row: np.ndarray,
+    X_blob: np.ndarray,
+    threshold: float,
+) -> List[List[int]]:
+    # Two unique images are duplicates only if their perceptual hashes are equal
+    # AND their image cosine is >= threshold: dHash ignores colour, so colour
+    # variants of one packshot share a hash but are separate products. Within a
+    # hash bucket each image joins the most similar group leader if that cosine
+    # reaches the threshold and otherwise becomes a leader itself, so merges never
+    # chain through intermediate members. Every manifest row then joins its
+    # image's group; images that failed to load have no hash and are never grouped.
+    leader = list(range(len(blob_hashes)))
+    buckets: Dict[int, List[int]] = {}
+    for i, h in enumerate(blob_hashes):
+        if h is not None:
+            buckets.setdefault(h, []).append(i)
+    for members in buckets.values():
+        if len(members) < 2:
+            continue
+        X = np.asarray(X_blob[members], dtype="float32")
+        leaders: List[int] = []
+        for j, blob in enumerate(members):
+            if leaders:
+                sims = X[leaders] @ X[j]
+                best = int(np.argmax(sims))
+                if sims[best] >= threshold:
+                    leader[blob] = members[leaders[best]]
+                    continue
+            leaders.append(j)
+
+    groups: Dict[object, List[int]] = {}
+    for row, blob in enumerate(blob_of_row):
+        key = leader[int(blob)] if blob_hashes[blob] is not None else ("row", row)
+        groups.setdefault(key, []).append(row)
+    return sorted(groups.values(), key=lambda g: g[0])
+
+
+def _collapse(X: np.ndarray, idx: np.ndarray, starts: np.ndarray) -> np.ndarray:
+    # Renormalised member means; idx lists the members of consecutive groups and
+    # starts is where each group begins in it
+    return _normalize(np.add.reduceat(np.asarray(X[idx], dtype="float32"), starts, axis=0))
+
+
+def _product_text(p: dict) -> str:
+    name = (p.get("name") or "").strip()
+    details = (p.get("details") or "").strip()
+    # Simple concatenation; customize if needed
+    text = name
+    if details and details.lower() != "nan":
+        text = f"{name}. {details}"
+    return text if text else name
+
+
+def _product_meta(pid: str, image_path: str, products_map: Dict[str, dict]) -> dict:
+    base = {"id": pid, "image_path": image_path}
+    if pid in products_map:
+        p = products_map[pid]
+        base.update({
+            "name": p.get("name"),
+            "link": p.get("link"),
+            "price": p.get("price"),
+            "details": p.get("details"),
+            "gender": p.get("gender"),
+            "category": p.get("category"),
+        })
+    return base
+
+
 def build_index(
     manifest_path: str,
     out_dir: str,
@@ -52,8 +144,13 @@ def build_index(
     batch_size: int = 8,
     products_jsonl: Optional[str] = None,
     alpha_image: float = 0.7,
+    dedupe: bool = True,
+    dedupe_threshold: float = 0.97,
+    num_shards: int = 1,
+    shard_by: str = "hash",
+    cascade_encoder: Optional[str] = None,
+    block_rows: int = 4096,
 ) -> str:
-    os.makedirs(out_dir, exist_ok=True)
     pairs = load_manifest(manifest_path)
     if not pairs:
         raise RuntimeError("No images found in manifest")
@@ -65,88 +162,165 @@ def build_index(
     image_paths = [p for _, p in pairs]
     product_ids = [pid for pid, _ in pairs]
 
-    embeddings_img_list: List[np.ndarray] = []
-    batch_images: List[Image.Image] = []
-
-    def flush_batch():
-        nonlocal embeddings_img_list, batch_images
-        if not batch_images:
-            return
-        embs = model.encode(
-            batch_images,
-            batch_size=len(batch_images) if len(batch_images) < batch_size else batch_size,
-            convert_to_numpy=True,
-            normalize_embeddings=True,
-            show_progress_bar=False,
-            num_workers=0,
-        )
-        embeddings_img_list.append(embs)
-        batch_images = []
-
-    for path in tqdm(image_paths, desc="Embedding images"):
-        try:
-            img = Image.open(path).convert("RGB")
-        except Exception:
-            img = Image.new("RGB", (224, 224), color=(0, 0, 0))
-        batch_images.append(img)
-        if len(batch_images) >= batch_size:
-            flush_batch()
-    flush_batch()
-
-    X_img = np.vstack(embeddings_img_list).astype("float32")
-
-    # Optional text embeddings
-    X_fused = X_img
-    if products_map:
-        texts: List[str] = []
-        for pid in product_ids:
-            p = products_map.get(pid, {})
-            name = (p.get("name") or "").strip()
-            details = (p.get("details") or "").strip()
-            # Simple concatenation; customize if needed
-            text = name
-            if details and details.lower() != "nan":
-                text = f"{name}. {details}"
-            texts.append(text if text else name)
-        X_txt = model.encode(
-            texts,
-            convert_to_numpy=True,
-            normalize_embeddings=True,
-            show_progress_bar=False,
-            num_workers=0,
-        ).astype("float32")
-        # Weighted fusion: alpha*image + (1-alpha)*text, then normalize
+    # Products sharing a downloaded blob share its embedding: each unique file is
+    # decoded and encoded once, then expanded back to one row per manifest line
+    unique_paths = list(dict.fromkeys(image_paths))
+    blob_row = {p: i for i, p in enumerate(unique_paths)}
+    blob_of_row = np.array([blob_row[p] for p in image_paths], dtype="int64")
+
+    # Embeddings stream into preallocated files in the new version directory and
+    # are collapsed and fused from there block by block, so peak memory is set by
+    # block_rows rather than by the catalog size. Intermediates live in _build/.
+    version_dir = new_version_dir(out_dir)
+    try:
+        scratch = os.path.join(version_dir, "_build")
+        X_blob: Optional[np.ndarray] = None
+        C_blob: Optional[np.ndarray] = None
+        blob_hashes: List[Optional[int]] = []
+        batch_images: List[Image.Image] = []
+        filled = 0
+
+        def flush_batch():
+            nonlocal X_blob, C_blob, batch_images, filled
+            if not batch_images:
+                return
+            embs = model.encode(
+                batch_images,
+                batch_size=len(batch_images) if len(batch_images) < batch_size else batch_size,
+                convert_to_numpy=True,
+                normalize_embeddings=True,
+                show_progress_bar=False,
+                num_workers=0,
+            )
+            if X_blob is None:
+                X_blob = create_vectors(os.path.join(scratch, "blob_image_vectors.npy"), len(unique_paths), embs.shape[1])
+            X_blob[filled:filled + len(embs)] = embs
+            if cascade_encoder:
+                c = encode_cascade(batch_images, cascade_encoder, device)
+                if C_blob is None:
+                    C_blob = create_vectors(os.path.join(scratch, "blob_cascade_vectors.npy"), len(unique_paths), c.shape[1])
+                C_blob[filled:filled + len(c)] = c
+            filled += len(embs)
+            if filled % block_rows < len(embs):
+                release_pages(X_blob)
+                release_pages(C_blob)
+            batch_images = []
+
+        print(f"Embedding {len(unique_paths)} unique images for {len(image_paths)} manifest rows")
+        for path in tqdm(unique_paths, desc="Embedding images"):
+            try:
+                img = Image.open(path).convert("RGB")
+                blob_hashes.append(_dhash(img) if dedupe else None)
+            except Exception:
+                img = Image.new("RGB", (224, 224), color=(0, 0, 0))
+                blob_hashes.append(None)
+            batch_images.append(img)
+            if len(batch_images) >= batch_size:
+                flush_batch()
+        flush_batch()
+
+        # Optional text embeddings, one row per manifest line, encoded a block at a time
+        X_row_txt: Optional[np.ndarray] = None
+        if products_map:
+            for start in range(0, len(product_ids), block_rows):
+                texts = [_product_text(products_map.get(pid, {})) for pid in product_ids[start:start + block_rows]]
+                embs = model.encode(
+                    texts,
+                    convert_to_numpy=True,
+                    normalize_embeddings=True,
+                    show_progress_bar=False,
+                    num_workers=0,
+                )
+                if X_row_txt is None:
+                    X_row_txt = create_vectors(os.path.join(scratch, "row_text_vectors.npy"), len(product_ids), embs.shape[1])
+                X_row_txt[start:start + len(embs)] = embs
+                release_pages(X_row_txt)
+
+        # Collapse near-duplicate images (same packshot under several categories or URLs)
+        # into one row whose vectors are the renormalised member means
+        if dedupe:
+            groups = _duplicate_groups(blob_hashes, blob_of_row, X_blob, dedupe_threshold)
+            print(f"Collapsed {len(image_paths)} images into {len(groups)} rows")
+        else:
+            groups = [[i] for i in range(len(image_paths))]
+
+        # Unsharded stores are filled at their final paths; sharded builds stage the
+        # full matrices in _build/ and copy each shard's rows out of them
+        sharded = not (num_shards <= 1 and shard_by == "hash")
+        target = scratch if sharded else version_dir
+        n_rows, dim = len(groups), X_blob.shape[1]
+        X_img = create_vectors(os.path.join(target, "image_vectors.npy"), n_rows, dim)
+        X_txt = None if X_row_txt is None else create_vectors(os.path.join(target, "text_vectors.npy"), n_rows, X_row_txt.shape[1])
+        X_fused = X_img if X_txt is None else create_vectors(os.path.join(target, VECTORS_FILE), n_rows, dim)
+        X_casc = None if C_blob is None else create_vectors(os.path.join(target, CASCADE_FILE), n_rows, C_blob.shape[1])
         alpha = float(alpha_image)
-        X_fused = _normalize(alpha * X_img + (1.0 - alpha) * X_txt)
-
-    d = X_fused.shape[1]
-    index = faiss.IndexFlatIP(d)
-    index.add(X_fused)
-
-    index_path = os.path.join(out_dir, "image_index.faiss")
-    faiss.write_index(index, index_path)
-
-    # Save metadata mapping index row -> product info and image path
-    meta_path = os.path.join(out_dir, "image_meta.json")
-    meta: List[dict] = []
-    for i in range(len(image_paths)):
-        pid = product_ids[i]
-        base = {"id": pid, "image_path": image_paths[i]}
-        if pid in products_map:
-            p = products_map[pid]
-            base.update({
-                "name": p.get("name"),
-                "link": p.get("link"),
-                "price": p.get("price"),
-                "details": p.get("details"),
-                "gender": p.get("gender"),
-                "category": p.get("category"),
-            })
-        meta.append(base)
-    with open(meta_path, "w") as f:
-        json.dump(meta, f)
-
-    return index_path
+        for start in range(0, n_rows, block_rows):
+            block = groups[start:start + block_rows]
+            end = start + len(block)
+            members = np.fromiter((i for g in block for i in g), dtype="int64")
+            starts = np.cumsum([0] + [len(g) for g in block[:-1]])
+            img_block = _collapse(X_blob, blob_of_row[members], starts)
+            X_img[start:end] = img_block
+            if X_txt is not None:
+                txt_block = _collapse(X_row_txt, members, starts)
+                X_txt[start:end] = txt_block
+                # Weighted fusion: alpha*image + (1-alpha)*text, then normalize
+                X_fused[start:end] = _normalize(alpha * img_block + (1.0 - alpha) * txt_block)
+            if X_casc is not None:
+                X_casc[start:end] = _collapse(C_blob, blob_of_row[members], starts)
+            for X in (X_blob, C_blob, X_row_txt, X_img, X_txt, X_fused, X_casc):
+                release_pages(X)
+
+        # Metadata maps index row -> product info and image path. Each row is
+        # described by its first member and lists every product id it represents.
+        meta: List[dict] = []
+        for g in groups:
+            members = [_product_meta(product_ids[i], image_paths[i], products_map) for i in g]
+            base = {**members[0], "ids": [m["id"] for m in members]}
+            if len(members) > 1:
+                base["members"] = members
+            meta.append(base)
+
+        # Published with an atomic symlink swap; the unfused vectors are kept so
+        # queries can pick their own alpha
+        info = {
+            "model": model_name,
+            "dim": int(dim),
+            "count": int(n_rows),
+            "alpha_image": alpha if X_txt is not None else 1.0,
+            "build_peak_rss_mb": round(peak_rss_mb(), 1),
+        }
+        if X_casc is not None:
+            info.update({"cascade_encoder": cascade_encoder, "cascade_dim": int(X_casc.shape[1])})
+        if not sharded:
+            write_store(version_dir, X_fused, meta, info, X_img=X_img, X_txt=X_txt, X_cascade=X_casc)
+        else:
+            # One complete store per shard; the coordinator in shards.py merges them at query time
+            parts = partition_rows(meta, shard_by, num_shards)
+            for name, rows in parts.items():
+                write_store(
+                    os.path.join(version_dir, "shards", name),
+                    X_fused,
+                    [meta[i] for i in rows],
+                    {**info, "count": len(rows)},
+                    X_img=X_img,
+                    X_txt=X_txt,
+                    X_cascade=X_casc,
+                    rows=np.asarray(rows, dtype="int64"),
+                )
+            write_shard_map(version_dir, shard_by, {name: len(rows) for name, rows in parts.items()})
+            with open(os.path.join(version_dir, "index_info.json"), "w") as f:
+                json.dump({**info, "shard_by": shard_by, "shards": len(parts)}, f)
+            print(f"Wrote {len(parts)} shards by {shard_by}")
+        del X_blob, C_blob, X_row_txt, X_img, X_txt, X_fused, X_casc
+        shutil.rmtree(scratch, ignore_errors=True)
+        print(f"Peak RSS {peak_rss_mb():.0f} MB")
+    except BaseException:
+        # publish_index only prunes published versions, so a failed or interrupted
+        # build removes its own staging directory
+        shutil.rmtree(version_dir, ignore_errors=True)
+        raise
+    return publish_index(version_dir, out_dir)
 
 
 if __name__ == "__main__":
@@ -160,6 +334,13 @@ if __name__ == "__main__":
     parser.add_argument("--batch_size", type=int, default=8)
     parser.add_argument("--products", default=None)
     parser.add_argument("--alpha_image", type=float, default=0.7)
+    parser.add_argument("--no_dedupe", action="store_true", help="Keep one row per image even for near-duplicates")
+    parser.add_argument("--dedupe_threshold", type=float, default=0.97, help="Image cosine at or above which rows with equal perceptual hashes are collapsed")
+    parser.add_argument("--num_shards", type=int, default=1, help="Number of hash shards (ignored for gender/category sharding)")
+    parser.add_argument("--shard_by", choices=SHARD_BY, default="hash")
+    parser.add_argument("--block_rows", type=int, default=4096, help="Rows per block when collapsing and fusing on disk; bounds build memory")
+    parser.add_argument("--cascade_encoder", default=None,
+                        help="Also store cheap first-stage vectors for cascade search: 'thumb' (pixel descriptor) or a smaller sentence-transformers model")
     args = parser.parse_args()
 
     path = build_index(
@@ -170,5 +351,11 @@ if __name__ == "__main__":
         batch_size=args.batch_size,
         products_jsonl=args.products,
         alpha_image=args.alpha_image,
+        dedupe=not args.no_dedupe,
+        dedupe_threshold=args.dedupe_threshold,
+        num_shards=args.num_shards,
+        shard_by=args.shard_by,
+        cascade_encoder=args.cascade_encoder,
+        block_rows=args.block_rows,
     )
     print(f"Index written to {path}")
@@ -0,0 +1,249 @@
+import os
+
+from image_search.runtime import configure_threads, cpu_count, set_child_blas_threads
+
+configure_threads("batch")
+
+import json
+import multiprocessing
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List, Optional
+
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+from image_search.query import walk_images
+
+# Bulk amount_sold prediction for large folders or manifests of candidate images.
+# A job directory holds the frozen input list, one columnar .npz part per finished
+# chunk and, once every chunk is done, the merged predictions.npz. Rerunning with
+# the same job directory skips finished chunks, so an interrupted run resumes.
+#
+# Columns: path (n,), ids (n, k), scores (n, k), predicted_avg (n,), ok (n,),
+# partial (n,) and failed_shards (n,). Missing neighbours are "" / NaN; images
+# that failed to load have ok=False; partial=True marks predictions made while
+# the listed shards of a sharded index did not answer.
+
+JOB_FILE = "job.json"
+INPUTS_FILE = "inputs.txt"
+PARTS_DIR = "parts"
+OUTPUT_FILE = "predictions.npz"
+
+
+def list_inputs(source: str) -> List[str]:
+    # A directory is walked for images; a .jsonl manifest (as written by the
+    # downloader) contributes its image_path fields; any other file lists one
+    # path per line
+    if os.path.isdir(source):
+        return walk_images(source)
+    with open(source, "r") as f:
+        lines = [line.strip() for line in f if line.strip()]
+    if source.endswith(".jsonl"):
+        return list(dict.fromkeys(json.loads(line)["image_path"] for line in lines))
+    return lines
+
+
+def _init_worker(model_name: str, device: str, threads: int) -> None:
+    # Loads the model once per worker process and splits the cores between workers
+    import torch
+
+    from image_search.query import get_model
+
+    get_model(model_name, device)
+    torch.set_num_threads(threads)
+
+
+def _predict_chunk(
+    paths: List[str],
+    index_dir: str,
+    top_k: int,
+    model_name: str,
+    device: str,
+    alpha: Optional[float],
+    batch_size: int,
+) -> Dict[str, np.ndarray]:
+    from image_search.query import get_model, search_hits_info
+    from image_search.query_avg import average_amount_sold
+
+    n = len(paths)
+    ids = np.full((n, top_k), "", dtype=object)
+    scores = np.full((n, top_k), np.nan, dtype="float32")
+    avg = np.full(n, np.nan, dtype="float32")
+    ok = np.zeros(n, dtype=bool)
+    partial = np.zeros(n, dtype=bool)
+    failed_shards = np.full(n, "", dtype=object)
+
+    # Images are decoded one encoder batch at a time and only the embeddings are
+    # kept, so memory does not grow with the chunk size
+    model = get_model(model_name, device)
+    rows: List[int] = []
+    embeddings: List[np.ndarray] = []
+    for start in range(0, n, batch_size):
+        images: List[Image.Image] = []
+        for i in range(start, min(start + batch_size, n)):
+            try:
+                with Image.open(paths[i]) as img:
+                    images.append(img.convert("RGB"))
+                rows.append(i)
+            except Exception:
+                continue
+        if images:
+            embeddings.append(model.encode(
+                images,
+                batch_size=batch_size,
+                convert_to_numpy=True,
+                normalize_embeddings=True,
+                show_progress_bar=False,
+                num_workers=0,
+            ).astype("float32"))
+    if rows:
+        q = np.concatenate(embeddings)
+        # One batched search for the whole chunk
+        found, info = search_hits_info(q, index_dir, top_k, alpha=alpha)
+        for i, hits in zip(rows, found):
+            for j, h in enumerate(hits):
+                ids[i, j] = h.get("id") or ""
+                scores[i, j] = h["score"]
+            avg[i] = average_amount_sold(hits)
+            ok[i] = True
+            partial[i] = info["partial"]
+            failed_shards[i] = ",".join(info["failed_shards"])
+    return {
+        "path": np.array(paths, dtype=str),
+        "ids": ids.astype(str),
+        "scores": scores,
+        "predicted_avg": avg,
+        "ok": ok,
+        "partial": partial,
+        "failed_shards": failed_shards.astype(str),
+    }
+
+
+def _part_path(job_dir: str, chunk: int) -> str:
+    return os.path.join(job_dir, PARTS_DIR, f"chunk-{chunk:06d}.npz")
+
+
+def _save_columns(path: str, columns: Dict[str, np.ndarray]) -> None:
+    # Atomic: a part either exists complete or not at all
+    tmp_path = f"{path[:-len('.npz')]}.tmp.npz"
+    np.savez_compressed(tmp_path, **columns)
+    os.replace(tmp_path, path)
+
+
+def load_predictions(path: str) -> Dict[str, np.ndarray]:
+    with np.load(path, allow_pickle=False) as z:
+        return {name: z[name] for name in z.files}
+
+
+def _open_job(job_dir: str, source: str, params: dict) -> List[str]:
+    job_path = os.path.join(job_dir, JOB_FILE)
+    inputs_path = os.path.join(job_dir, INPUTS_FILE)
+    if os.path.exists(job_path):
+        with open(job_path, "r") as f:
+            job = json.load(f)
+        if job["params"] != params:
+            raise ValueError(f"{job_dir} holds a job with different parameters; use a new --job_dir")
+        if job.get("index_version") != os.path.realpath(params["index_dir"]):
+            warnings.warn("The index was republished since this job started; resumed chunks use the new version")
+        with open(inputs_path, "r") as f:
+            return [line.rstrip("\n") for line in f]
+
+    paths = list_inputs(source)
+    if not paths:
+        raise FileNotFoundError(f"No images found in {source}")
+    os.makedirs(os.path.join(job_dir, PARTS_DIR), exist_ok=True)
+    with open(inputs_path, "w") as f:
+        f.writelines(f"{p}\n" for p in paths)
+    # Written last: its presence means the input list is complete
+    with open(job_path, "w") as f:
+        json.dump({"params": params, "index_version": os.path.realpath(params["index_dir"]), "count": len(paths)}, f)
+    return paths
+
+
+def bulk_predict(
+    source: str,
+    job_dir: str,
+    index_dir: str,
+    top_k: int = 5,
+    model_name: str = "clip-ViT-B-32",
+    device: str = "cpu",
+    alpha: Optional[float] = None,
+    batch_size: int = 32,
+    chunk_size: int = 512,
+    workers: int = 1,
+) -> str:
+    params = {
+        "source": os.path.abspath(source),
+        "index_dir": os.path.abspath(index_dir),
+        "top_k": top_k,
+        "model": model_name,
+        "alpha": alpha,
+        "chunk_size": chunk_size,
+    }
+    paths = _open_job(job_dir, source, params)
+    chunks = [paths[s:s + chunk_size] for s in range(0, len(paths), chunk_size)]
+    pending = [i for i in range(len(chunks)) if not os.path.exists(_part_path(job_dir, i))]
+    if len(pending) < len(chunks):
+        print(f"Resuming: {len(chunks) - len(pending)} of {len(chunks)} chunks already done")
+
+    args = (params["index_dir"], top_k, model_name, device, alpha, batch_size)
+    if workers <= 1:
+        for i in tqdm(pending, desc="Predicting", unit="chunk"):
+            _save_columns(_part_path(job_dir, i), _predict_chunk(chunks[i], *args))
+    else:
+        # Spawned workers read their BLAS thread counts from the environment at
+        # start; values the user set win over the per-worker split
+        threads = max(1, cpu_count() // workers)
+        set_child_blas_threads(threads)
+        ctx = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(workers, mp_context=ctx, initializer=_init_worker, initargs=(model_name, device, threads)) as ex:
+            futures = {ex.submit(_predict_chunk, chunks[i], *args): i for i in pending}
+            for fut in tqdm(as_completed(futures), total=len(futures), desc="Predicting", unit="chunk"):
+                _save_columns(_part_path(job_dir, futures[fut]), fut.result())
+
+    parts = [load_predictions(_part_path(job_dir, i)) for i in range(len(chunks))]
+    out_path = os.path.join(job_dir, OUTPUT_FILE)
+    _save_columns(out_path, {name: np.concatenate([p[name] for p in parts]) for name in parts[0]})
+    return out_path
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Predict amount_sold for every image in a folder or manifest, resumably")
+    parser.add_argument("--input", required=True, help="Image directory, images manifest (.jsonl) or a file with one path per line")
+    parser.add_argument("--job_dir", required=True, help="Checkpoints and output; rerun with the same directory to resume")
+    parser.add_argument("--index_dir", default="vector_index")
+    parser.add_argument("--top_k", type=int, default=5)
+    parser.add_argument("--model", default="clip-ViT-B-32")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--alpha", type=float, default=None, help="Image weight (text gets 1-alpha); defaults to the build-time weight")
+    parser.add_argument("--batch_size", type=int, default=32, help="Images per encoder call")
+    parser.add_argument("--chunk_size", type=int, default=512, help="Images per checkpointed chunk")
+    parser.add_argument("--workers", type=int, default=1, help="Encoder processes; the cores are split between them")
+    args = parser.parse_args()
+
+    t0 = time.perf_counter()
+    path = bulk_predict(
+        args.input,
+        args.job_dir,
+        args.index_dir,
+        top_k=args.top_k,
+        model_name=args.model,
+        device=args.device,
+        alpha=args.alpha,
+        batch_size=args.batch_size,
+        chunk_size=args.chunk_size,
+        workers=args.workers,
+    )
+    cols = load_predictions(path)
+    print(json.dumps({
+        "output": path,
+        "images": int(len(cols["ok"])),
+        "failed": int((~cols["ok"]).sum()),
+        "partial": int(cols["partial"].sum()),
+        "elapsed_s": round(time.perf_counter() - t0, 1),
+    }))
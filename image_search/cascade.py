@@ -0,0 +1,183 @@
+import os
+
+from image_search.runtime import configure_threads
+
+configure_threads("query")
+
+import json
+import time
+from functools import lru_cache
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from PIL import Image
+
+from image_search.index_store import CASCADE_FILE, INFO_FILE, topk_inner_product
+from image_search.query import walk_images
+
+# Two-stage search. build_index(cascade_encoder=...) stores a second, much cheaper
+# embedding of every row as cascade_vectors.npy; at query time it shortlists a few
+# hundred rows and only those are scored with the full CLIP query embedding.
+# "thumb" is a pixel descriptor (tiny thumbnail plus colour histogram) that needs no
+# model; any other name is loaded with sentence-transformers (a smaller model).
+
+THUMB_ENCODER = "thumb"
+DEFAULT_CANDIDATES = 300
+
+
+def thumb_embedding(img: Image.Image, size: int = 8, bins: int = 4) -> np.ndarray:
+    rgb = img.convert("RGB")
+    thumb = np.asarray(rgb.resize((size, size), Image.BILINEAR), dtype="float32").reshape(-1) / 255.0
+    thumb -= thumb.mean()
+    thumb /= np.linalg.norm(thumb) + 1e-12
+    # Square-rooted colour histogram has unit norm already
+    px = np.asarray(rgb.resize((32, 32), Image.BILINEAR), dtype="int64") * bins // 256
+    codes = (px[..., 0] * bins + px[..., 1]) * bins + px[..., 2]
+    hist = np.sqrt(np.bincount(codes.reshape(-1), minlength=bins ** 3) / codes.size)
+    return (np.concatenate([thumb, hist]) / np.sqrt(2.0)).astype("float32")
+
+
+def encode_cascade(images: List[Image.Image], encoder: str = THUMB_ENCODER, device: str = "cpu") -> np.ndarray:
+    if encoder == THUMB_ENCODER:
+        return np.stack([thumb_embedding(img) for img in images]).astype("float32")
+    from image_search.query import get_model
+
+    return get_model(encoder, device).encode(
+        images,
+        convert_to_numpy=True,
+        normalize_embeddings=True,
+        show_progress_bar=False,
+        num_workers=0,
+    ).astype("float32")
+
+
+@lru_cache(maxsize=4)
+def _read_cascade(real_dir: str, mtime: float) -> Tuple[np.ndarray, str]:
+    X = np.load(os.path.join(real_dir, CASCADE_FILE), mmap_mode="r")
+    with open(os.path.join(real_dir, INFO_FILE), "r") as f:
+        encoder = json.load(f).get("cascade_encoder", THUMB_ENCODER)
+    return X, encoder
+
+
+def load_cascade(index_dir: str) -> Tuple[np.ndarray, str]:
+    real_dir = os.path.realpath(index_dir)
+    path = os.path.join(real_dir, CASCADE_FILE)
+    if not os.path.exists(path):
+        raise FileNotFoundError("No cascade vectors in this index. Rebuild with --cascade_encoder to use cascade search.")
+    return _read_cascade(real_dir, os.path.getmtime(path))
+
+
+def shortlist_images(images: List[Image.Image], index_dir: str, candidates: int = DEFAULT_CANDIDATES, device: str = "cpu") -> np.ndarray:
+    # (n_images, candidates) row ids from the cheap index, -1 padded
+    X, encoder = load_cascade(index_dir)
+    return topk_inner_product(encode_cascade(images, encoder, device), X, candidates)[1]
+
+
+def _image_paths(inputs: Sequence[str]) -> List[str]:
+    paths: List[str] = []
+    for p in inputs:
+        if os.path.isdir(p):
+            paths.extend(walk_images(p))
+        elif os.path.isfile(p):
+            paths.append(p)
+    return paths
+
+
+def cascade_agreement(
+    inputs: Sequence[str],
+    index_dir: str,
+    top_k: int = 5,
+    candidates: Sequence[int] = (DEFAULT_CANDIDATES,),
+    model_name: str = "clip-ViT-B-32",
+    device: str = "cpu",
+    alpha: Optional[float] = None,
+    limit: int = 0,
+) -> Dict[str, object]:
+    # Runs every query single-stage and through the cascade at each shortlist size,
+    # reporting top-k overlap and per-stage latency. The full query embedding is
+    # computed once per image and shared, so the timings isolate what differs.
+    from image_search.query import get_model, rerank_candidates, search_vectors
+    from image_search.replay import result_drift
+
+    paths = _image_paths(inputs)
+    if limit:
+        paths = paths[:limit]
+    if not paths:
+        raise FileNotFoundError("No query images found")
+    model = get_model(model_name, device)
+    X_casc, encoder = load_cascade(index_dir)
+
+    single: List[List[int]] = []
+    cascaded: Dict[int, List[List[int]]] = {c: [] for c in candidates}
+    recall: Dict[int, List[float]] = {c: [] for c in candidates}
+    timings: Dict[str, List[float]] = {"full_encode": [], "single_search": [], "cheap_encode": []}
+    for c in candidates:
+        timings[f"shortlist_{c}"] = []
+        timings[f"rerank_{c}"] = []
+    for path in paths:
+        with Image.open(path) as raw:
+            img = raw.convert("RGB")
+        t0 = time.perf_counter()
+        q = model.encode([img], convert_to_numpy=True, normalize_embeddings=True, num_workers=0, show_progress_bar=False).astype("float32")
+        t1 = time.perf_counter()
+        _, idxs = search_vectors(q, index_dir, top_k, alpha=alpha)
+        t2 = time.perf_counter()
+        c_vec = encode_cascade([img], encoder, device)
+        t3 = time.perf_counter()
+        timings["full_encode"].append(t1 - t0)
+        timings["single_search"].append(t2 - t1)
+        timings["cheap_encode"].append(t3 - t2)
+        ref = [int(i) for i in idxs[0] if i >= 0]
+        single.append(ref)
+        for c in candidates:
+            t4 = time.perf_counter()
+            cand = topk_inner_product(c_vec, X_casc, c)[1]
+            t5 = time.perf_counter()
+            _, c_idxs = rerank_candidates(q, cand, index_dir, top_k, alpha=alpha)
+            t6 = time.perf_counter()
+            timings[f"shortlist_{c}"].append(t5 - t4)
+            timings[f"rerank_{c}"].append(t6 - t5)
+            cascaded[c].append([int(i) for i in c_idxs[0] if i >= 0])
+            # Share of the single-stage top-k that survived the shortlist at all
+            recall[c].append(len(set(ref) & set(int(i) for i in cand[0])) / max(len(ref), 1))
+
+    report: Dict[str, object] = {
+        "queries": len(paths),
+        "rows": int(X_casc.shape[0]),
+        "cascade_encoder": encoder,
+        "top_k": top_k,
+        "latency_ms": {name: float(np.mean(v) * 1000.0) for name, v in timings.items()},
+    }
+    for c in candidates:
+        report[f"candidates_{c}"] = {
+            **result_drift(single, cascaded[c]),
+            "shortlist_recall_at_k": float(np.mean(recall[c])),
+        }
+    return report
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Compare cascade search against single-stage search")
+    parser.add_argument("--images", nargs="+", required=True, help="Query image files or directories")
+    parser.add_argument("--index_dir", default="vector_index")
+    parser.add_argument("--top_k", type=int, default=5)
+    parser.add_argument("--candidates", default=str(DEFAULT_CANDIDATES), help="Comma-separated shortlist sizes")
+    parser.add_argument("--model", default="clip-ViT-B-32")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--alpha", type=float, default=None)
+    parser.add_argument("--limit", type=int, default=0)
+    args = parser.parse_args()
+
+    report = cascade_agreement(
+        args.images,
+        args.index_dir,
+        top_k=args.top_k,
+        candidates=[int(c) for c in args.candidates.split(",")],
+        model_name=args.model,
+        device=args.device,
+        alpha=args.alpha,
+        limit=args.limit,
+    )
+    print(json.dumps(report, indent=2))
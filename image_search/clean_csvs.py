@@ -1,11 +1,14 @@
 import csv
 import os
 import re
-from typing import List, Tuple
+from typing import Dict, List, Optional, Tuple
 
 import pandas as pd
 
 from .csv_loader import list_category_csvs
+from .ingest_state import row_digest, sync_sources
+
+STATE_FILE = ".ingest_state.json"
 
 
 def _clean_text(text: str) -> str:
@@ -38,55 +41,70 @@ def _normalize_header(df: pd.DataFrame) -> Tuple[str, str, str, str, str]:
     return name_col or "", link_col or "", img_col or "", price_col or "", details_col or ""
 
 
-def clean_all_to_csv(root_dir: str, out_root: str) -> None:
-    for gender, category, path in list_category_csvs(root_dir):
-        try:
-            df = pd.read_csv(path)
-        except Exception:
-            continue
-
-        name_col, link_col, img_col, price_col, details_col = _normalize_header(df)
-        if not name_col or not link_col:
-            continue
-
-        out_dir = os.path.join(out_root, gender)
-        os.makedirs(out_dir, exist_ok=True)
-        out_path = os.path.join(out_dir, f"{category}.csv")
-
-        with open(out_path, "w", newline="") as f:
-            writer = csv.writer(f)
-            writer.writerow(["id", "name", "details", "gender", "category"])
-
-            for _, row in df.iterrows():
-                try:
-                    rid = str(row.get(df.columns[0], "")).strip()
-                    link = str(row.get(link_col, "")).strip()
-                    if not rid or rid == "nan":
-                        rid = link.rsplit("/", 1)[-1] if link else ""
-                    if not link:
-                        continue
-                    name_raw = str(row.get(name_col, "")).strip()
-                    name = re.sub(r"https?://\S+", "", name_raw).strip()
-                    details_raw = "" if not details_col else str(row.get(details_col, "")).strip()
-                    details = _clean_text(details_raw)
-
-                    writer.writerow(
-                        [
-                            f"{gender}:{category}:{rid}",
-                            name,
-                            details,
-                            gender,
-                            category,
-                        ]
-                    )
-                except Exception:
+def _clean_category(gender: str, category: str, path: str, out_path: str) -> Optional[Dict[str, str]]:
+    try:
+        df = pd.read_csv(path)
+    except Exception:
+        return None
+
+    name_col, link_col, img_col, price_col, details_col = _normalize_header(df)
+    if not name_col or not link_col:
+        return None
+
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    ids: Dict[str, str] = {}
+    # Written aside and renamed, so an interrupted run never leaves a partial file
+    tmp_path = f"{out_path}.tmp"
+    with open(tmp_path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["id", "name", "details", "gender", "category"])
+
+        for _, row in df.iterrows():
+            try:
+                rid = str(row.get(df.columns[0], "")).strip()
+                link = str(row.get(link_col, "")).strip()
+                if not rid or rid == "nan":
+                    rid = link.rsplit("/", 1)[-1] if link else ""
+                if not link:
                     continue
+                name_raw = str(row.get(name_col, "")).strip()
+                name = re.sub(r"https?://\S+", "", name_raw).strip()
+                details_raw = "" if not details_col else str(row.get(details_col, "")).strip()
+                details = _clean_text(details_raw)
+
+                out_row = [
+                    f"{gender}:{category}:{rid}",
+                    name,
+                    details,
+                    gender,
+                    category,
+                ]
+                writer.writerow(out_row)
+                ids[out_row[0]] = row_digest(out_row)
+            except Exception:
+                continue
+    os.replace(tmp_path, out_path)
+    return ids
+
+
+def clean_all_to_csv(root_dir: str, out_root: str, state_path: Optional[str] = None, force: bool = False) -> Dict[str, List[str]]:
+    # Only category files whose content changed since the last run are re-cleaned;
+    # returns the added/updated/removed product ids
+    return sync_sources(
+        list_category_csvs(root_dir),
+        state_path or os.path.join(out_root, STATE_FILE),
+        lambda gender, category: os.path.join(out_root, gender, f"{category}.csv"),
+        _clean_category,
+        force=force,
+    )
 
 
 if __name__ == "__main__":
     repo_root = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
     data_root = repo_root
     out_root = os.path.join(repo_root, "cleaned_csv")
-    clean_all_to_csv(data_root, out_root)
+    changes = clean_all_to_csv(data_root, out_root)
+    print(f"{len(changes['changed_files'])} category files cleaned: "
+          f"{len(changes['added'])} added, {len(changes['updated'])} updated, {len(changes['removed'])} removed")
 
 
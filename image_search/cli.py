@@ -1,7 +1,13 @@
 import os
 import argparse
 
-from image_search.csv_loader import load_products, save_products_jsonl
+# Before pandas/numpy load via csv_loader, so BLAS picks up the build thread budget
+from image_search.runtime import configure_threads
+
+configure_threads("build")
+
+from image_search.csv_loader import load_products_incremental, save_products_jsonl
+from image_search.ingest_state import CHANGES_FILE, write_changes
 from image_search.downloader import download_catalog_images
 from image_search.build_index import build_index
 
@@ -15,14 +21,19 @@ def main():
     parser.add_argument("--model", default="clip-ViT-B-32")
     parser.add_argument("--device", default="cpu")
     parser.add_argument("--alpha_image", type=float, default=0.7, help="Weight for image in fusion; text gets 1-alpha")
+    parser.add_argument("--full", action="store_true", help="Re-parse every category CSV even if unchanged")
     args = parser.parse_args()
 
     os.makedirs(args.work_dir, exist_ok=True)
 
-    products = load_products(args.root)
+    # Only category CSVs changed since the last run are parsed; the change set is
+    # left in the work dir for downstream stages
+    products, changes = load_products_incremental(args.root, args.work_dir, force=args.full)
     products_path = os.path.join(args.work_dir, "products.jsonl")
     save_products_jsonl(products, products_path)
-    print(f"Saved {len(products)} products -> {products_path}")
+    write_changes(os.path.join(args.work_dir, CHANGES_FILE), changes)
+    print(f"Saved {len(products)} products -> {products_path} "
+          f"({len(changes['added'])} added, {len(changes['updated'])} updated, {len(changes['removed'])} removed)")
 
     manifest = download_catalog_images(products_path, args.images_dir)
     print(f"Manifest at {manifest}")
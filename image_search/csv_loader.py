@@ -8,6 +8,8 @@ import pandas as pd
 import requests
 from bs4 import BeautifulSoup
 
+from image_search.ingest_state import row_digest, sync_sources
+
 
 @dataclass
 class ProductRecord:
@@ -72,66 +74,105 @@ def scrape_primary_image(product_url: str, timeout: int = 10) -> List[str]:
         return []
 
 
-def load_products(root_dir: str) -> List[ProductRecord]:
+def _parse_category(gender: str, category: str, path: str) -> Optional[List[ProductRecord]]:
+    try:
+        # Some files have slight header differences; let pandas infer
+        df = pd.read_csv(path)
+    except Exception:
+        return None
+    # Normalize column names
+    cols = {c.strip().lower().replace(" ", "_") for c in df.columns}
+    name_col = next((c for c in df.columns if c.strip().lower() in {"product_name", "name"}), None)
+    link_col = next((c for c in df.columns if c.strip().lower() in {"link", "product_link"}), None)
+    img_col = next((c for c in df.columns if c.strip().lower() in {"product_image", "product_images", "image", "images"}), None)
+    price_col = next((c for c in df.columns if c.strip().lower() in {"price"}), None)
+    details_col = next((c for c in df.columns if c.strip().lower() in {"details", "description"}), None)
+
+    if link_col is None or name_col is None:
+        return None
+
     products: List[ProductRecord] = []
-    for gender, category, path in list_category_csvs(root_dir):
+    for _, row in df.iterrows():
         try:
-            # Some files have slight header differences; let pandas infer
-            df = pd.read_csv(path)
+            # ID: try first column if numeric index; else derive from link
+            rid = str(row.get(df.columns[0], "")).strip()
+            if not rid or rid == "nan":
+                rid = str(row.get("id", "")).strip()
+            link = str(row.get(link_col, "")).strip()
+            if not rid:
+                rid = link.rsplit("/", 1)[-1] if link else os.urandom(4).hex()
+            name = str(row.get(name_col, "")).strip()
+            price = None if price_col is None else str(row.get(price_col, "")).strip()
+            details = None if details_col is None else str(row.get(details_col, "")).strip()
+
+            image_urls: List[str] = []
+            if img_col is not None:
+                image_urls = parse_image_list(str(row.get(img_col, "")).strip())
+            if not image_urls and link:
+                # Fallback: try scraping one image
+                image_urls = scrape_primary_image(link)
+
+            if not image_urls:
+                # Skip products without any image candidates
+                continue
+
+            products.append(
+                ProductRecord(
+                    id=f"{gender}:{category}:{rid}",
+                    name=name,
+                    link=link,
+                    image_urls=image_urls,
+                    price=price if price and price.lower() != "nan" else None,
+                    details=details if details and details.lower() != "nan" else None,
+                    gender=gender,
+                    category=category,
+                )
+            )
         except Exception:
             continue
-        # Normalize column names
-        cols = {c.strip().lower().replace(" ", "_") for c in df.columns}
-        name_col = next((c for c in df.columns if c.strip().lower() in {"product_name", "name"}), None)
-        link_col = next((c for c in df.columns if c.strip().lower() in {"link", "product_link"}), None)
-        img_col = next((c for c in df.columns if c.strip().lower() in {"product_image", "product_images", "image", "images"}), None)
-        price_col = next((c for c in df.columns if c.strip().lower() in {"price"}), None)
-        details_col = next((c for c in df.columns if c.strip().lower() in {"details", "description"}), None)
-
-        if link_col is None or name_col is None:
-            continue
+    return products
 
-        for _, row in df.iterrows():
-            try:
-                # ID: try first column if numeric index; else derive from link
-                rid = str(row.get(df.columns[0], "")).strip()
-                if not rid or rid == "nan":
-                    rid = str(row.get("id", "")).strip()
-                link = str(row.get(link_col, "")).strip()
-                if not rid:
-                    rid = link.rsplit("/", 1)[-1] if link else os.urandom(4).hex()
-                name = str(row.get(name_col, "")).strip()
-                price = None if price_col is None else str(row.get(price_col, "")).strip()
-                details = None if details_col is None else str(row.get(details_col, "")).strip()
-
-                image_urls: List[str] = []
-                if img_col is not None:
-                    image_urls = parse_image_list(str(row.get(img_col, "")).strip())
-                if not image_urls and link:
-                    # Fallback: try scraping one image
-                    image_urls = scrape_primary_image(link)
-
-                if not image_urls:
-                    # Skip products without any image candidates
-                    continue
-
-                products.append(
-                    ProductRecord(
-                        id=f"{gender}:{category}:{rid}",
-                        name=name,
-                        link=link,
-                        image_urls=image_urls,
-                        price=price if price and price.lower() != "nan" else None,
-                        details=details if details and details.lower() != "nan" else None,
-                        gender=gender,
-                        category=category,
-                    )
-                )
-            except Exception:
-                continue
+
+def load_products(root_dir: str) -> List[ProductRecord]:
+    products: List[ProductRecord] = []
+    for gender, category, path in list_category_csvs(root_dir):
+        products.extend(_parse_category(gender, category, path) or [])
     return products
 
 
+def _write_category_part(gender: str, category: str, path: str, part_path: str) -> Optional[Dict[str, str]]:
+    products = _parse_category(gender, category, path)
+    if products is None:
+        return None
+    os.makedirs(os.path.dirname(part_path), exist_ok=True)
+    tmp_path = f"{part_path}.tmp"
+    save_products_jsonl(products, tmp_path)
+    os.replace(tmp_path, part_path)
+    return {p.id: row_digest(p.__dict__) for p in products}
+
+
+def load_products_incremental(root_dir: str, work_dir: str, force: bool = False) -> Tuple[List[ProductRecord], Dict[str, List[str]]]:
+    # Like load_products, but parsed categories are kept under
+    # work_dir/products_parts/ and only re-parsed (and re-scraped) when their CSV
+    # changed. Returns every product plus the added/updated/removed ids.
+    parts_dir = os.path.join(work_dir, "products_parts")
+    changes = sync_sources(
+        list_category_csvs(root_dir),
+        os.path.join(work_dir, "products_state.json"),
+        lambda gender, category: os.path.join(parts_dir, gender, f"{category}.jsonl"),
+        _write_category_part,
+        force=force,
+    )
+    products: List[ProductRecord] = []
+    for gender, category, _ in sorted(list_category_csvs(root_dir)):
+        part_path = os.path.join(parts_dir, gender, f"{category}.jsonl")
+        if not os.path.exists(part_path):
+            continue
+        with open(part_path, "r") as f:
+            products.extend(ProductRecord(**json.loads(line)) for line in f if line.strip())
+    return products, changes
+
+
 def save_products_jsonl(products: List[ProductRecord], out_path: str) -> None:
     with open(out_path, "w") as f:
         for p in products:
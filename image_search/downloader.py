@@ -1,35 +1,99 @@
 import hashlib
 import json
 import os
+import shutil
+import tempfile
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple
 
 import requests
 from tqdm import tqdm
 
+# Images are stored by content hash under blobs/, so identical bytes served from
+# different URLs are kept (and later embedded) once. url_map.json records which
+# blob each URL resolved to, and the manifest lists one line per (product, blob).
+
+URL_MAP_FILE = "url_map.json"
+
 
 def _safe_filename(url: str) -> str:
     h = hashlib.sha256(url.encode("utf-8")).hexdigest()[:24]
     return f"{h}.jpg"
 
 
+def blob_path(out_dir: str, digest: str) -> str:
+    return os.path.join(out_dir, "blobs", digest[:2], f"{digest}.jpg")
+
+
+def _store_blob(tmp_path: str, out_dir: str, digest: str) -> str:
+    path = blob_path(out_dir, digest)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.exists(path):
+        os.remove(tmp_path)
+    else:
+        # Atomic rename: concurrent writers of the same content end with one complete file
+        os.replace(tmp_path, path)
+    return path
+
+
+def _file_digest(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
 def download_image(url: str, out_dir: str, timeout: int = 20) -> Tuple[str, bool]:
     os.makedirs(out_dir, exist_ok=True)
-    fname = _safe_filename(url)
-    path = os.path.join(out_dir, fname)
-    if os.path.exists(path):
+    # Adopt files from the older URL-keyed cache without fetching them again
+    legacy = os.path.join(out_dir, _safe_filename(url))
+    if os.path.exists(legacy):
+        digest = _file_digest(legacy)
+        path = blob_path(out_dir, digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".part")
+            os.close(fd)
+            shutil.copyfile(legacy, tmp_path)
+            _store_blob(tmp_path, out_dir, digest)
         return path, True
+    tmp_path: Optional[str] = None
     try:
         resp = requests.get(url, timeout=timeout, headers={"User-Agent": "Mozilla/5.0"}, stream=True)
         if resp.status_code != 200:
-            return path, False
-        with open(path, "wb") as f:
+            return "", False
+        h = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=out_dir, suffix=".part")
+        with os.fdopen(fd, "wb") as f:
             for chunk in resp.iter_content(chunk_size=8192):
                 if chunk:
+                    h.update(chunk)
                     f.write(chunk)
+        path = _store_blob(tmp_path, out_dir, h.hexdigest())
+        tmp_path = None
         return path, True
     except Exception:
-        return path, False
+        return "", False
+    finally:
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def load_url_map(out_dir: str) -> Dict[str, str]:
+    path = os.path.join(out_dir, URL_MAP_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def save_url_map(out_dir: str, url_map: Dict[str, str]) -> None:
+    path = os.path.join(out_dir, URL_MAP_FILE)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(url_map, f)
+    os.replace(tmp_path, path)
 
 
 def download_catalog_images(products_jsonl: str, out_dir: str, max_workers: int = 16, top_n_per_product: int = 2) -> str:
@@ -47,18 +111,31 @@ def download_catalog_images(products_jsonl: str, out_dir: str, max_workers: int
         for url in (p.get("image_urls") or [])[:top_n_per_product]:
             tasks.append((p["id"], url))
 
-    results: List[Tuple[str, str]] = []
+    # Each distinct URL is fetched at most once, and not at all if its blob is cached
+    url_map = load_url_map(out_dir)
+    pending = [
+        url for url in dict.fromkeys(url for _, url in tasks)
+        if url not in url_map or not os.path.exists(blob_path(out_dir, url_map[url]))
+    ]
     with ThreadPoolExecutor(max_workers=max_workers) as ex:
-        futures = {ex.submit(download_image, url, out_dir): (pid, url) for pid, url in tasks}
+        futures = {ex.submit(download_image, url, out_dir): url for url in pending}
         for fut in tqdm(as_completed(futures), total=len(futures), desc="Downloading images"):
-            pid, url = futures[fut]
             path, ok = fut.result()
             if ok:
-                results.append((pid, path))
+                url_map[futures[fut]] = os.path.splitext(os.path.basename(path))[0]
+    save_url_map(out_dir, url_map)
 
-    # Write manifest
+    # Write manifest: one line per (product, blob), so many products can share a file
+    seen = set()
+    digests = set()
     with open(manifest_path, "w") as f:
-        for pid, path in results:
-            f.write(json.dumps({"id": pid, "image_path": path}) + "\n")
+        for pid, url in tasks:
+            digest = url_map.get(url)
+            if digest is None or (pid, digest) in seen:
+                continue
+            seen.add((pid, digest))
+            digests.add(digest)
+            f.write(json.dumps({"id": pid, "image_path": blob_path(out_dir, digest), "url": url, "sha256": digest}) + "\n")
+    print(f"{len(seen)} product images backed by {len(digests)} unique blobs")
 
     return manifest_path
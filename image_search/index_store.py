@@ -0,0 +1,256 @@
+import json
+import mmap
+import os
+import shutil
+import tempfile
+import time
+from functools import lru_cache
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+# On-disk index directory format. Every file is read-only after publishing and is
+# memory-mapped by readers, so processes on one host share the page cache:
+#   vectors.npy        fused float32 (n, d) matrix searched by default
+#   image_vectors.npy  unfused image vectors (query-time alpha)
+#   text_vectors.npy   unfused text vectors, when the build had product text
+#   cascade_vectors.npy  optional cheap first-stage vectors (see cascade.py)
+#   meta.jsonl         one JSON object per row
+#   meta_offsets.npy   int64 (n + 1) byte offsets of each row in meta.jsonl
+#   index_info.json    build parameters
+# Directories are published by pointing a symlink at a new version directory,
+# so readers see either the old or the new index, never a mix. Published versions
+# carry a .published marker; only those are ever pruned.
+
+STORE_FORMAT = 1
+VECTORS_FILE = "vectors.npy"
+META_FILE = "meta.jsonl"
+OFFSETS_FILE = "meta_offsets.npy"
+INFO_FILE = "index_info.json"
+CASCADE_FILE = "cascade_vectors.npy"
+# Marks a version directory that has been published; unmarked ones are staging
+PUBLISHED_FILE = ".published"
+
+
+def is_store(index_dir: str) -> bool:
+    return os.path.exists(os.path.join(index_dir, VECTORS_FILE)) and os.path.exists(os.path.join(index_dir, META_FILE))
+
+
+def topk_inner_product(Q: np.ndarray, X: np.ndarray, k: int, block_rows: int = 65536) -> Tuple[np.ndarray, np.ndarray]:
+    # Exact inner-product top-k over X in row blocks, returning faiss-shaped arrays
+    Q = np.ascontiguousarray(Q, dtype="float32")
+    nq, n = Q.shape[0], X.shape[0]
+    k_eff = min(k, n)
+    best_s = np.empty((nq, 0), dtype="float32")
+    best_i = np.empty((nq, 0), dtype="int64")
+    for start in range(0, n, block_rows):
+        S = Q @ np.asarray(X[start:start + block_rows], dtype="float32").T
+        ids = np.broadcast_to(np.arange(start, start + S.shape[1], dtype="int64"), S.shape)
+        best_s = np.concatenate([best_s, S], axis=1)
+        best_i = np.concatenate([best_i, ids], axis=1)
+        if best_s.shape[1] > k_eff:
+            part = np.argpartition(-best_s, k_eff - 1, axis=1)[:, :k_eff]
+            best_s = np.take_along_axis(best_s, part, axis=1)
+            best_i = np.take_along_axis(best_i, part, axis=1)
+    order = np.argsort(-best_s, axis=1)
+    scores = np.full((nq, k), -np.inf, dtype="float32")
+    idxs = np.full((nq, k), -1, dtype="int64")
+    scores[:, :k_eff] = np.take_along_axis(best_s, order, axis=1)
+    idxs[:, :k_eff] = np.take_along_axis(best_i, order, axis=1)
+    return scores, idxs
+
+
+class MmapFlatIndex:
+    # Minimal stand-in for faiss.IndexFlatIP over a memory-mapped matrix
+
+    def __init__(self, vectors: np.ndarray):
+        self.vectors = vectors
+        self.ntotal = int(vectors.shape[0])
+        self.d = int(vectors.shape[1])
+
+    def search(self, q: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        return topk_inner_product(q, self.vectors, k)
+
+
+class MetaStore:
+    # Read-only list-like view over meta.jsonl; rows are parsed only when accessed
+
+    def __init__(self, meta_path: str, offsets_path: str):
+        self.offsets = np.load(offsets_path, mmap_mode="r")
+        with open(meta_path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(meta_path) else b""
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> dict:
+        i = int(i)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return json.loads(self._mm[int(self.offsets[i]):int(self.offsets[i + 1])])
+
+    def __iter__(self) -> Iterator[dict]:
+        for i in range(len(self)):
+            yield self[i]
+
+
+def write_meta(out_dir: str, meta: Iterable[dict]) -> None:
+    # Unlink first: in a cloned version these names are hard links into the live one
+    for name in (META_FILE, OFFSETS_FILE):
+        if os.path.exists(os.path.join(out_dir, name)):
+            os.remove(os.path.join(out_dir, name))
+    offsets = [0]
+    with open(os.path.join(out_dir, META_FILE), "wb") as f:
+        for rec in meta:
+            f.write((json.dumps(rec, ensure_ascii=False) + "\n").encode("utf-8"))
+            offsets.append(f.tell())
+    np.save(os.path.join(out_dir, OFFSETS_FILE), np.asarray(offsets, dtype="int64"))
+
+
+def read_meta(index_dir: str) -> List[dict]:
+    with open(os.path.join(index_dir, META_FILE), "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def create_vectors(path: str, n: int, d: int) -> np.ndarray:
+    # Preallocated float32 .npy on disk, filled in place through a memory map
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if n == 0:
+        # Zero-length files cannot be mapped
+        np.save(path, np.empty((0, d), dtype="float32"))
+        return np.load(path)
+    return np.lib.format.open_memmap(path, mode="w+", dtype="float32", shape=(n, d))
+
+
+def release_pages(X: np.ndarray) -> None:
+    # Writes back dirty pages and drops the mapping's resident pages, so filling a
+    # large file block by block does not grow the process RSS with it
+    if not isinstance(X, np.memmap):
+        return
+    X.flush()
+    mm = getattr(X, "_mmap", None)
+    if mm is not None and hasattr(mmap, "MADV_DONTNEED"):
+        mm.madvise(mmap.MADV_DONTNEED)
+
+
+def _save_vectors(path: str, X: np.ndarray, rows: Optional[np.ndarray] = None, block_rows: int = 65536) -> None:
+    if rows is None and isinstance(X, np.memmap) and X.filename and os.path.abspath(X.filename) == os.path.abspath(path):
+        # Already filled in place at its final location
+        X.flush()
+        return
+    n = X.shape[0] if rows is None else len(rows)
+    out = create_vectors(path, n, X.shape[1])
+    for start in range(0, n, block_rows):
+        sel = slice(start, start + block_rows) if rows is None else rows[start:start + block_rows]
+        out[start:start + block_rows] = X[sel]
+        release_pages(out)
+        release_pages(X)
+    del out
+
+
+def write_store(
+    out_dir: str,
+    X_fused: np.ndarray,
+    meta: Iterable[dict],
+    info: dict,
+    X_img: Optional[np.ndarray] = None,
+    X_txt: Optional[np.ndarray] = None,
+    X_cascade: Optional[np.ndarray] = None,
+    rows: Optional[np.ndarray] = None,
+) -> None:
+    # rows selects a subset of the given matrices (one shard); they are copied in
+    # blocks so neither the source nor the subset is ever fully in memory
+    os.makedirs(out_dir, exist_ok=True)
+    _save_vectors(os.path.join(out_dir, VECTORS_FILE), X_fused, rows)
+    if X_img is not None:
+        _save_vectors(os.path.join(out_dir, "image_vectors.npy"), X_img, rows)
+    if X_txt is not None:
+        _save_vectors(os.path.join(out_dir, "text_vectors.npy"), X_txt, rows)
+    if X_cascade is not None:
+        _save_vectors(os.path.join(out_dir, CASCADE_FILE), X_cascade, rows)
+    write_meta(out_dir, meta)
+    with open(os.path.join(out_dir, INFO_FILE), "w") as f:
+        json.dump({"format": STORE_FORMAT, **info}, f)
+
+
+@lru_cache(maxsize=8)
+def _open_store(real_dir: str, mtime: float):
+    index = MmapFlatIndex(np.load(os.path.join(real_dir, VECTORS_FILE), mmap_mode="r"))
+    meta = MetaStore(os.path.join(real_dir, META_FILE), os.path.join(real_dir, OFFSETS_FILE))
+    return index, meta
+
+
+def load_store(index_dir: str):
+    if not is_store(index_dir):
+        raise FileNotFoundError("Index or metadata not found. Build the index first.")
+    # Keyed on the resolved directory so a published swap opens the new version
+    real_dir = os.path.realpath(index_dir)
+    return _open_store(real_dir, os.path.getmtime(os.path.join(real_dir, META_FILE)))
+
+
+def _versions_dir(index_dir: str) -> str:
+    return os.path.abspath(index_dir).rstrip(os.sep) + ".versions"
+
+
+def new_version_dir(index_dir: str) -> str:
+    # Staging directory on the same filesystem as the published symlink
+    versions = _versions_dir(index_dir)
+    os.makedirs(versions, exist_ok=True)
+    return tempfile.mkdtemp(prefix=time.strftime("%Y%m%d-%H%M%S-"), dir=versions)
+
+
+def _mark_published(version_dir: str) -> None:
+    with open(os.path.join(version_dir, PUBLISHED_FILE), "w") as f:
+        f.write(f"{time.time()}\n")
+
+
+def publish_index(version_dir: str, index_dir: str, keep: int = 2) -> str:
+    index_dir = os.path.abspath(index_dir).rstrip(os.sep)
+    versions = _versions_dir(index_dir)
+    if os.path.isdir(index_dir) and not os.path.islink(index_dir):
+        # One-time migration of a plain directory into the versioned layout
+        os.makedirs(versions, exist_ok=True)
+        legacy = os.path.join(versions, f"legacy-{time.strftime('%Y%m%d-%H%M%S')}")
+        os.rename(index_dir, legacy)
+        _mark_published(legacy)
+    _mark_published(version_dir)
+    tmp_link = f"{index_dir}.tmp-{os.getpid()}"
+    os.symlink(os.path.relpath(version_dir, os.path.dirname(index_dir)), tmp_link)
+    os.replace(tmp_link, index_dir)
+
+    # Old published versions are removed, newest kept first; processes still
+    # mapping their files keep them until unmapped. Directories without the marker
+    # are staging areas of builds or clones still in progress and are never touched.
+    current = os.path.realpath(index_dir)
+    published = [
+        os.path.join(versions, d) for d in os.listdir(versions)
+        if os.path.exists(os.path.join(versions, d, PUBLISHED_FILE))
+    ]
+    published = sorted(
+        (d for d in published if os.path.realpath(d) != current),
+        key=lambda d: os.path.getmtime(os.path.join(d, PUBLISHED_FILE)),
+        reverse=True,
+    )
+    for d in published[max(keep - 1, 0):]:
+        shutil.rmtree(d, ignore_errors=True)
+    return index_dir
+
+
+def clone_version(index_dir: str) -> str:
+    # New version sharing unchanged files with the current one through hard links
+    src = os.path.realpath(index_dir)
+    dst = new_version_dir(index_dir)
+    for name in os.listdir(src):
+        if name == PUBLISHED_FILE:
+            continue
+        s, d = os.path.join(src, name), os.path.join(dst, name)
+        if os.path.isdir(s):
+            shutil.copytree(s, d, copy_function=os.link)
+            continue
+        try:
+            os.link(s, d)
+        except OSError:
+            shutil.copy2(s, d)
+    return dst
@@ -0,0 +1,128 @@
+import hashlib
+import json
+import os
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Incremental ingestion of per-category CSVs. A state file records, for every
+# source file, its size, mtime and content hash, the per-category output it
+# produced and a digest of every product row in it. Unchanged files are skipped,
+# and comparing row digests before and after a run yields the change set
+# (added / updated / removed product ids) for downstream stages.
+
+STATE_FORMAT = 1
+CHANGES_FILE = "changes.json"
+
+# (gender, category, source path, output path) -> {product id: row digest}
+ProcessFn = Callable[[str, str, str, str], Optional[Dict[str, str]]]
+
+
+def row_digest(rec) -> str:
+    return hashlib.sha256(json.dumps(rec, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def file_fingerprint(path: str, with_hash: bool = True) -> dict:
+    st = os.stat(path)
+    fp = {"size": st.st_size, "mtime": st.st_mtime_ns}
+    if with_hash:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        fp["sha256"] = h.hexdigest()
+    return fp
+
+
+def load_state(state_path: str) -> dict:
+    if not os.path.exists(state_path):
+        return {"format": STATE_FORMAT, "files": {}}
+    with open(state_path, "r") as f:
+        state = json.load(f)
+    if state.get("format") != STATE_FORMAT:
+        return {"format": STATE_FORMAT, "files": {}}
+    return state
+
+
+def save_state(state_path: str, state: dict) -> None:
+    os.makedirs(os.path.dirname(os.path.abspath(state_path)), exist_ok=True)
+    tmp_path = f"{state_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, state_path)
+
+
+def _unchanged(entry: Optional[dict], path: str) -> Tuple[bool, dict]:
+    # Size and mtime match: trusted without reading the file. Otherwise the content
+    # hash decides, so a touched-but-identical file is not re-parsed.
+    quick = file_fingerprint(path, with_hash=False)
+    if entry is None or entry.get("size") != quick["size"]:
+        return False, file_fingerprint(path)
+    if entry.get("mtime") == quick["mtime"]:
+        return True, {**quick, "sha256": entry.get("sha256")}
+    fp = file_fingerprint(path)
+    return fp["sha256"] == entry.get("sha256"), fp
+
+
+def sync_sources(
+    sources: List[Tuple[str, str, str]],
+    state_path: str,
+    output_for: Callable[[str, str], str],
+    process: ProcessFn,
+    force: bool = False,
+) -> Dict[str, List[str]]:
+    # process(gender, category, source, output) writes the category's output file
+    # and returns the row digests it wrote, or None if the source was unusable.
+    # Outputs of sources that disappeared are deleted.
+    state = load_state(state_path)
+    old_files: Dict[str, dict] = state["files"]
+    new_files: Dict[str, dict] = {}
+    changed_files: List[str] = []
+    for gender, category, path in sorted(sources):
+        key = f"{gender}/{category}"
+        output = output_for(gender, category)
+        entry = old_files.get(key)
+        same, fp = _unchanged(entry, path)
+        if same and not force and os.path.exists(output):
+            new_files[key] = {**entry, **fp}
+            continue
+        ids = process(gender, category, path, output)
+        if ids is None and os.path.exists(output):
+            os.remove(output)
+        new_files[key] = {"path": os.path.abspath(path), **fp, "output": output, "ids": ids or {}}
+        changed_files.append(key)
+    removed_files = sorted(set(old_files) - set(new_files))
+    for key in removed_files:
+        output = old_files[key].get("output")
+        if output and os.path.exists(output):
+            os.remove(output)
+
+    old_ids = {pid: d for e in old_files.values() for pid, d in e.get("ids", {}).items()}
+    new_ids = {pid: d for e in new_files.values() for pid, d in e.get("ids", {}).items()}
+    changes = {
+        "added": sorted(set(new_ids) - set(old_ids)),
+        "updated": sorted(pid for pid in set(new_ids) & set(old_ids) if new_ids[pid] != old_ids[pid]),
+        "removed": sorted(set(old_ids) - set(new_ids)),
+        "changed_files": changed_files,
+        "removed_files": removed_files,
+    }
+    state["files"] = new_files
+    save_state(state_path, state)
+    return changes
+
+
+def write_changes(path: str, changes: Dict[str, List[str]]) -> None:
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(changes, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def concat_parts(parts: List[str], out_path: str) -> None:
+    # Rebuilds a combined JSONL from per-category parts without re-parsing rows
+    os.makedirs(os.path.dirname(os.path.abspath(out_path)), exist_ok=True)
+    tmp_path = f"{out_path}.tmp"
+    with open(tmp_path, "wb") as out:
+        for part in parts:
+            with open(part, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    out.write(chunk)
+    os.replace(tmp_path, out_path)
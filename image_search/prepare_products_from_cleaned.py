@@ -1,10 +1,13 @@
 import csv
 import json
 import os
-from typing import Generator, Tuple
+from typing import Dict, Generator, List, Optional, Tuple
 
+from image_search.ingest_state import concat_parts, row_digest, sync_sources
 
-def iter_cleaned_rows(cleaned_root: str) -> Generator[Tuple[str, str, str, str, str], None, None]:
+
+def list_cleaned_csvs(cleaned_root: str) -> List[Tuple[str, str, str]]:
+    records: List[Tuple[str, str, str]] = []
     for gender in ("Men", "Women"):
         gender_dir = os.path.join(cleaned_root, gender)
         if not os.path.isdir(gender_dir):
@@ -12,24 +15,34 @@ def iter_cleaned_rows(cleaned_root: str) -> Generator[Tuple[str, str, str, str,
         for fname in os.listdir(gender_dir):
             if not fname.lower().endswith(".csv"):
                 continue
-            category = fname[:-4]
-            path = os.path.join(gender_dir, fname)
-            with open(path, newline="") as f:
-                reader = csv.DictReader(f)
-                for row in reader:
-                    yield (
-                        row.get("id", ""),
-                        row.get("name", "") or "",
-                        row.get("details", "") or "",
-                        row.get("gender", gender),
-                        row.get("category", category),
-                    )
-
-
-def write_products_jsonl(cleaned_root: str, out_path: str) -> None:
-    os.makedirs(os.path.dirname(out_path), exist_ok=True)
-    with open(out_path, "w") as out:
-        for pid, name, details, gender, category in iter_cleaned_rows(cleaned_root):
+            records.append((gender, fname[:-4], os.path.join(gender_dir, fname)))
+    return records
+
+
+def _iter_csv_rows(gender: str, category: str, path: str) -> Generator[Tuple[str, str, str, str, str], None, None]:
+    with open(path, newline="") as f:
+        reader = csv.DictReader(f)
+        for row in reader:
+            yield (
+                row.get("id", ""),
+                row.get("name", "") or "",
+                row.get("details", "") or "",
+                row.get("gender", gender),
+                row.get("category", category),
+            )
+
+
+def iter_cleaned_rows(cleaned_root: str) -> Generator[Tuple[str, str, str, str, str], None, None]:
+    for gender, category, path in list_cleaned_csvs(cleaned_root):
+        yield from _iter_csv_rows(gender, category, path)
+
+
+def _write_part(gender: str, category: str, path: str, part_path: str) -> Optional[Dict[str, str]]:
+    os.makedirs(os.path.dirname(part_path), exist_ok=True)
+    ids: Dict[str, str] = {}
+    tmp_path = f"{part_path}.tmp"
+    with open(tmp_path, "w") as out:
+        for pid, name, details, gender, category in _iter_csv_rows(gender, category, path):
             if not pid:
                 continue
             rec = {
@@ -40,13 +53,38 @@ def write_products_jsonl(cleaned_root: str, out_path: str) -> None:
                 "category": category,
             }
             out.write(json.dumps(rec, ensure_ascii=False) + "\n")
+            ids[pid] = row_digest(rec)
+    os.replace(tmp_path, part_path)
+    return ids
+
+
+def write_products_jsonl(cleaned_root: str, out_path: str, state_path: Optional[str] = None, force: bool = False) -> Dict[str, List[str]]:
+    # Each cleaned category file is converted into its own part under
+    # <out_path>.parts/ only when it changed; the output is the concatenation of
+    # all parts. Returns the added/updated/removed product ids.
+    parts_dir = f"{out_path}.parts"
+    changes = sync_sources(
+        list_cleaned_csvs(cleaned_root),
+        state_path or f"{out_path}.state.json",
+        lambda gender, category: os.path.join(parts_dir, gender, f"{category}.jsonl"),
+        _write_part,
+        force=force,
+    )
+    if changes["changed_files"] or changes["removed_files"] or not os.path.exists(out_path):
+        parts = sorted(
+            os.path.join(root, f)
+            for root, _, files in os.walk(parts_dir)
+            for f in files
+            if f.endswith(".jsonl")
+        )
+        concat_parts(parts, out_path)
+    return changes
 
 
 if __name__ == "__main__":
     repo_root = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
     cleaned_root = os.path.join(repo_root, "cleaned_csv")
     out_path = os.path.join(repo_root, ".work", "products_cleaned.jsonl")
-    write_products_jsonl(cleaned_root, out_path)
+    changes = write_products_jsonl(cleaned_root, out_path)
     print(out_path)
-
-
+    print(f"{len(changes['added'])} added, {len(changes['updated'])} updated, {len(changes['removed'])} removed")
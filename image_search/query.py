@@ -1,48 +1,262 @@
 import os
-# Constrain thread counts to avoid segfaults on macOS/Python 3.13
-os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
-os.environ.setdefault("OMP_NUM_THREADS", "1")
-os.environ.setdefault("MKL_NUM_THREADS", "1")
+
+# Thread budgets must be in the environment before numpy/torch load
+from image_search.runtime import apply_threads, configure_threads, env_flag
+
+configure_threads("query")
 
 import json
-from typing import List
+import time
+import warnings
+from functools import lru_cache
+from typing import List, Optional, Tuple
 
-import faiss  # type: ignore
 import numpy as np
 from PIL import Image
-from sentence_transformers import SentenceTransformer
+
+from image_search.index_store import MmapFlatIndex, is_store, load_store
+from image_search.query_log import log_query, query_log_path
+from image_search.shards import is_sharded
+
+# faiss, torch and sentence_transformers are imported lazily so that `--help`,
+# argument errors and worker-backed invocations never pay for them.
+
+# File extensions accepted as query images wherever a folder or upload is scanned
+IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".webp")
+
+
+def walk_images(directory: str) -> List[str]:
+    # Image files under directory, in a stable order
+    paths: List[str] = []
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        paths.extend(os.path.join(root, f) for f in sorted(files) if f.lower().endswith(IMAGE_EXTS))
+    return paths
+
+
+@lru_cache(maxsize=4)
+def _read_index(index_path: str, meta_path: str, mtime: float):
+    import faiss  # type: ignore
+
+    index = faiss.read_index(index_path)
+    with open(meta_path, "r") as f:
+        meta = json.load(f)
+    return index, meta
 
 
 def load_index(index_dir: str):
+    # Memory-mapped store written by build_index; older directories hold a
+    # faiss file and a JSON list instead and are read into process memory
+    if is_store(index_dir):
+        return load_store(index_dir)
     index_path = os.path.join(index_dir, "image_index.faiss")
     meta_path = os.path.join(index_dir, "image_meta.json")
     if not (os.path.exists(index_path) and os.path.exists(meta_path)):
         raise FileNotFoundError("Index or metadata not found. Build the index first.")
-    index = faiss.read_index(index_path)
-    with open(meta_path, "r") as f:
-        meta = json.load(f)
-    return index, meta
+    # Keyed on mtimes so a rebuilt index or re-annotated metadata is picked up
+    mtime = max(os.path.getmtime(index_path), os.path.getmtime(meta_path))
+    return _read_index(os.path.realpath(index_path), os.path.realpath(meta_path), mtime)
 
 
-def search_image(query_image_path: str, index_dir: str, top_k: int = 5, model_name: str = "clip-ViT-B-32", device: str = "cpu") -> List[dict]:
-    if not os.path.isfile(query_image_path):
-        raise FileNotFoundError(f"Query image not found: {query_image_path}")
-    index, meta = load_index(index_dir)
+@lru_cache(maxsize=4)
+def _read_factored(img_path: str, txt_path: str, mtime: float):
+    X_img = np.load(img_path, mmap_mode="r")
+    X_txt = np.load(txt_path, mmap_mode="r")
+    return X_img, X_txt, MmapFlatIndex(X_img), MmapFlatIndex(X_txt)
+
+
+def load_factored(index_dir: str):
+    img_path = os.path.join(index_dir, "image_vectors.npy")
+    txt_path = os.path.join(index_dir, "text_vectors.npy")
+    if not (os.path.exists(img_path) and os.path.exists(txt_path)):
+        raise FileNotFoundError("Separate image/text vectors not found. Rebuild the index to query with a custom alpha.")
+    mtime = max(os.path.getmtime(img_path), os.path.getmtime(txt_path))
+    return _read_factored(os.path.realpath(img_path), os.path.realpath(txt_path), mtime)
+
+
+def search_fused(q: np.ndarray, index_dir: str, top_k: int, alpha: float, candidates: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    X_img, X_txt, index_img, index_txt = load_factored(index_dir)
+    a = float(alpha)
+    n_cand = min(max(candidates, 4 * top_k, 50), X_img.shape[0])
+    # Candidates come from the image and text indexes separately (skipping a side
+    # whose weight is zero) and are then re-scored exactly against
+    # normalize(a*x_img + (1-a)*x_txt), which is what a fused index would hold.
+    found = []
+    if a > 0.0:
+        found.append(index_img.search(q, n_cand)[1])
+    if a < 1.0:
+        found.append(index_txt.search(q, n_cand)[1])
+    scores = np.full((q.shape[0], top_k), -np.inf, dtype="float32")
+    idxs = np.full((q.shape[0], top_k), -1, dtype="int64")
+    for i in range(q.shape[0]):
+        cand = np.unique(np.concatenate([f[i] for f in found]))
+        cand = cand[cand >= 0]
+        s = _fused_scores(q[i], X_img[cand], X_txt[cand], a)
+        order = np.argsort(-s)[:top_k]
+        scores[i, :len(order)] = s[order]
+        idxs[i, :len(order)] = cand[order]
+    return scores, idxs
+
+
+def _fused_scores(q: np.ndarray, xi: np.ndarray, xt: np.ndarray, a: float) -> np.ndarray:
+    cos = np.einsum("ij,ij->i", xi, xt)
+    norm = np.sqrt(a * a + (1.0 - a) ** 2 + 2.0 * a * (1.0 - a) * cos) + 1e-12
+    return (a * (xi @ q) + (1.0 - a) * (xt @ q)) / norm
+
+
+def search_vectors(q: np.ndarray, index_dir: str, top_k: int, alpha: Optional[float] = None) -> Tuple[np.ndarray, np.ndarray]:
+    # alpha=None searches the fused index with the weight chosen at build time;
+    # an index built without text has nothing to re-weight
+    image_only = os.path.exists(os.path.join(index_dir, "image_vectors.npy")) and not os.path.exists(os.path.join(index_dir, "text_vectors.npy"))
+    if alpha is None or image_only:
+        index, _ = load_index(index_dir)
+        return index.search(q, top_k)
+    return search_fused(q, index_dir, top_k, alpha)
+
+
+def rerank_candidates(q: np.ndarray, cand: np.ndarray, index_dir: str, top_k: int, alpha: Optional[float] = None) -> Tuple[np.ndarray, np.ndarray]:
+    # Exact scores for the given rows only (cand is (nq, c), -1 padded), with the
+    # same alpha semantics as search_vectors
+    image_only = os.path.exists(os.path.join(index_dir, "image_vectors.npy")) and not os.path.exists(os.path.join(index_dir, "text_vectors.npy"))
+    if alpha is None or image_only:
+        index, _ = load_index(index_dir)
+        X = index.vectors
+    else:
+        X_img, X_txt, _, _ = load_factored(index_dir)
+    scores = np.full((q.shape[0], top_k), -np.inf, dtype="float32")
+    idxs = np.full((q.shape[0], top_k), -1, dtype="int64")
+    for i in range(q.shape[0]):
+        # Sorted rows read the memory map front to back
+        c = np.unique(cand[i][cand[i] >= 0])
+        if alpha is None or image_only:
+            s = np.asarray(X[c], dtype="float32") @ q[i]
+        else:
+            s = _fused_scores(q[i], X_img[c], X_txt[c], float(alpha))
+        order = np.argsort(-s)[:top_k]
+        scores[i, :len(order)] = s[order]
+        idxs[i, :len(order)] = c[order]
+    return scores, idxs
+
+
+def search_hits_info(
+    q: np.ndarray,
+    index_dir: str,
+    top_k: int,
+    alpha: Optional[float] = None,
+    cand: Optional[np.ndarray] = None,
+) -> Tuple[List[List[dict]], dict]:
+    # Scored metadata rows for each query vector, scattering over shards when the
+    # index directory is sharded, plus {"partial", "failed_shards"} describing
+    # shards missing from the result. cand restricts scoring to a shortlist of rows.
+    if is_sharded(index_dir):
+        if cand is not None:
+            raise ValueError("Cascade search is not supported on sharded indexes")
+        from image_search.shards import search_shards
+
+        hits, info = search_shards(q, index_dir, top_k, alpha=alpha)
+        return hits, {"partial": info["partial"], "failed_shards": info["failed_shards"]}
+    _, meta = load_index(index_dir)
+    if cand is not None:
+        scores, idxs = rerank_candidates(q, cand, index_dir, top_k, alpha=alpha)
+    else:
+        scores, idxs = search_vectors(q, index_dir, top_k, alpha=alpha)
+    hits = [
+        [{"score": float(score), **meta[int(idx)]} for score, idx in zip(srow, irow) if idx >= 0]
+        for srow, irow in zip(scores, idxs)
+    ]
+    return hits, {"partial": False, "failed_shards": []}
+
+
+def _warn_partial(info: dict) -> None:
+    if info["partial"]:
+        warnings.warn(f"Partial results: shards {', '.join(info['failed_shards'])} did not answer in time")
+
+
+def search_hits(
+    q: np.ndarray,
+    index_dir: str,
+    top_k: int,
+    alpha: Optional[float] = None,
+    cand: Optional[np.ndarray] = None,
+) -> List[List[dict]]:
+    # As search_hits_info, warning about partial results instead of returning them
+    hits, info = search_hits_info(q, index_dir, top_k, alpha=alpha, cand=cand)
+    _warn_partial(info)
+    return hits
+
+
+@lru_cache(maxsize=2)
+def get_model(model_name: str = "clip-ViT-B-32", device: str = "cpu"):
+    from sentence_transformers import SentenceTransformer
+
     model = SentenceTransformer(model_name, device=device)
+    apply_threads()
+    return model
+
+
+def search_pil_image(
+    img: Image.Image,
+    index_dir: str,
+    top_k: int = 5,
+    model_name: str = "clip-ViT-B-32",
+    device: str = "cpu",
+    alpha: Optional[float] = None,
+    source: Optional[str] = None,
+    op: str = "search_image",
+    cascade: int = 0,
+    return_info: bool = False,
+):
+    # source/op only describe the query in the optional query log. cascade > 0
+    # shortlists that many rows with the index's cheap encoder and re-ranks only
+    # those with the full embedding. return_info=True returns (hits, info) with the
+    # partial/failed_shards flags of a sharded search instead of warning.
+    t0 = time.perf_counter()
+    model = get_model(model_name, device)
 
-    img = Image.open(query_image_path).convert("RGB")
+    img = img.convert("RGB")
+    cand = None
+    if cascade > 0:
+        from image_search.cascade import shortlist_images
+
+        cand = shortlist_images([img], index_dir, cascade, device=device)
     q = model.encode([img], convert_to_numpy=True, normalize_embeddings=True, num_workers=0, show_progress_bar=False).astype("float32")
-    scores, idxs = index.search(q, top_k)
-    results: List[dict] = []
-    for score, idx in zip(scores[0], idxs[0]):
-        if idx < 0:
+    hits, info = search_hits_info(q, index_dir, top_k, alpha=alpha, cand=cand)
+    hits = hits[0]
+    if query_log_path():
+        filters = {"alpha": alpha, **({"cascade": cascade} if cascade > 0 else {})}
+        log_query(img, source, op, index_dir, top_k, filters, time.perf_counter() - t0, hits)
+    if return_info:
+        return hits, info
+    _warn_partial(info)
+    return hits
+
+
+def expand_members(hits: List[dict]) -> List[dict]:
+    # One result per product id for rows that collapsed near-duplicate images
+    expanded: List[dict] = []
+    for h in hits:
+        members = h.get("members")
+        if not members:
+            expanded.append({k: v for k, v in h.items() if k != "ids"})
             continue
-        item = meta[idx]
-        results.append({
-            "score": float(score),
-            **item,
-        })
-    return results
+        for m in members:
+            expanded.append({"score": h.get("score"), **m})
+    return expanded
+
+
+def search_image(
+    query_image_path: str,
+    index_dir: str,
+    top_k: int = 5,
+    model_name: str = "clip-ViT-B-32",
+    device: str = "cpu",
+    alpha: Optional[float] = None,
+    cascade: int = 0,
+) -> List[dict]:
+    if not os.path.isfile(query_image_path):
+        raise FileNotFoundError(f"Query image not found: {query_image_path}")
+    with Image.open(query_image_path) as img:
+        return search_pil_image(img, index_dir, top_k=top_k, model_name=model_name, device=device, alpha=alpha, source=query_image_path, cascade=cascade)
 
 
 if __name__ == "__main__":
@@ -54,8 +268,20 @@ if __name__ == "__main__":
     parser.add_argument("--top_k", type=int, default=5)
     parser.add_argument("--model", default="clip-ViT-B-32")
     parser.add_argument("--device", default="cpu")
+    parser.add_argument("--alpha", type=float, default=None, help="Image weight for this query (text gets 1-alpha); defaults to the build-time weight")
+    parser.add_argument("--cascade", type=int, default=0, help="Shortlist size for two-stage search (index built with --cascade_encoder); 0 searches every row")
+    parser.add_argument("--expand", action="store_true", help="List every product id behind collapsed duplicate rows")
+    parser.add_argument("--worker", action="store_true", default=env_flag("IMAGE_SEARCH_WORKER"),
+                        help="Run through the persistent local worker, starting it if needed (or set IMAGE_SEARCH_WORKER=1)")
     args = parser.parse_args()
 
-    hits = search_image(args.image, args.index_dir, top_k=args.top_k, model_name=args.model, device=args.device)
+    if args.worker:
+        from image_search.worker import call_worker
+
+        hits = call_worker("search_image", image=args.image, index_dir=args.index_dir, top_k=args.top_k, model_name=args.model, device=args.device, alpha=args.alpha, cascade=args.cascade)
+    else:
+        hits = search_image(args.image, args.index_dir, top_k=args.top_k, model_name=args.model, device=args.device, alpha=args.alpha, cascade=args.cascade)
+    if args.expand:
+        hits = expand_members(hits)
     for h in hits:
         print(json.dumps(h, ensure_ascii=False))
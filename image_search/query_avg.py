@@ -1,51 +1,39 @@
 import os
 import json
-from typing import List
+import sys
+from typing import List, Optional
 
-import faiss  # type: ignore
-import numpy as np
 from PIL import Image
-from sentence_transformers import SentenceTransformer
 
-# Constrain threads
-os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
-os.environ.setdefault("OMP_NUM_THREADS", "1")
-os.environ.setdefault("MKL_NUM_THREADS", "1")
+# Thread configuration and lazy heavy imports come with image_search.query
+from image_search.query import expand_members, search_pil_image
+from image_search.runtime import env_flag
 
 
-def load_index(index_dir: str):
-    index_path = os.path.join(index_dir, "image_index.faiss")
-    meta_path = os.path.join(index_dir, "image_meta.json")
-    if not (os.path.exists(index_path) and os.path.exists(meta_path)):
-        raise FileNotFoundError("Index or metadata not found. Build the index first.")
-    index = faiss.read_index(index_path)
-    with open(meta_path, "r") as f:
-        meta = json.load(f)
-    return index, meta
-
-
-def search_topk(query_image_path: str, index_dir: str, top_k: int, model_name: str = "clip-ViT-B-32", device: str = "cpu") -> List[dict]:
+def search_topk(
+    query_image_path: str,
+    index_dir: str,
+    top_k: int,
+    model_name: str = "clip-ViT-B-32",
+    device: str = "cpu",
+    alpha: Optional[float] = None,
+    return_info: bool = False,
+):
+    # return_info=True returns (hits, info) so callers can flag predictions made
+    # while some shards were missing
     if not os.path.isfile(query_image_path):
         raise FileNotFoundError(query_image_path)
-    index, meta = load_index(index_dir)
-    model = SentenceTransformer(model_name, device=device)
-
-    img = Image.open(query_image_path).convert("RGB")
-    q = model.encode([img], convert_to_numpy=True, normalize_embeddings=True, num_workers=0, show_progress_bar=False).astype("float32")
-    scores, idxs = index.search(q, top_k)
-    results: List[dict] = []
-    for score, idx in zip(scores[0], idxs[0]):
-        if idx < 0:
-            continue
-        item = meta[idx]
-        item = {**item, "score": float(score)}
-        results.append(item)
-    return results
+    with Image.open(query_image_path) as img:
+        return search_pil_image(
+            img, index_dir, top_k=top_k, model_name=model_name, device=device, alpha=alpha,
+            source=query_image_path, op="search_topk", return_info=return_info,
+        )
 
 
 def average_amount_sold(items: List[dict]) -> float:
+    # Collapsed duplicate rows count once per product behind them
     vals: List[float] = []
-    for it in items:
+    for it in expand_members(items):
         if "amount_sold" in it and isinstance(it["amount_sold"], (int, float)):
             vals.append(float(it["amount_sold"]))
     if not vals:
@@ -62,11 +50,21 @@ if __name__ == "__main__":
     parser.add_argument("--top_k", type=int, default=5)
     parser.add_argument("--model", default="clip-ViT-B-32")
     parser.add_argument("--device", default="cpu")
+    parser.add_argument("--alpha", type=float, default=None, help="Image weight for this query (text gets 1-alpha); defaults to the build-time weight")
     parser.add_argument("--only_avg", action="store_true", help="Print only the numeric average amount_sold")
+    parser.add_argument("--worker", action="store_true", default=env_flag("IMAGE_SEARCH_WORKER"),
+                        help="Run through the persistent local worker, starting it if needed (or set IMAGE_SEARCH_WORKER=1)")
     args = parser.parse_args()
 
-    hits = search_topk(args.image, args.index_dir, top_k=args.top_k, model_name=args.model, device=args.device)
+    if args.worker:
+        from image_search.worker import call_worker
+
+        hits, info = call_worker("search_topk", image=args.image, index_dir=args.index_dir, top_k=args.top_k, model_name=args.model, device=args.device, alpha=args.alpha, return_info=True)
+    else:
+        hits, info = search_topk(args.image, args.index_dir, top_k=args.top_k, model_name=args.model, device=args.device, alpha=args.alpha, return_info=True)
     avg = average_amount_sold(hits)
+    if info["partial"]:
+        print(f"Partial results: shards {', '.join(info['failed_shards'])} did not answer in time", file=sys.stderr)
     if args.only_avg:
         # Print just the float for easy piping
         print(f"{avg}")
@@ -75,5 +73,7 @@ if __name__ == "__main__":
             "query_image": args.image,
             "top_k": args.top_k,
             "average_amount_sold": avg,
+            "partial": info["partial"],
+            "failed_shards": info["failed_shards"],
             "items": hits,
         }, ensure_ascii=False))
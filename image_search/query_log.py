@@ -0,0 +1,89 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import warnings
+from typing import List, Optional
+
+from PIL import Image
+
+# Structured query capture. When IMAGE_SEARCH_QUERY_LOG names a file, every search
+# appends one JSON line with the input hash, parameters, latency and result ids.
+# Queries made from in-memory images (app uploads) have no source path; setting
+# IMAGE_SEARCH_QUERY_LOG_INPUTS to a directory stores those inputs by hash so the
+# log can be replayed later.
+
+QUERY_LOG_ENV = "IMAGE_SEARCH_QUERY_LOG"
+QUERY_INPUTS_ENV = "IMAGE_SEARCH_QUERY_LOG_INPUTS"
+
+_lock = threading.Lock()
+
+
+def query_log_path() -> Optional[str]:
+    return os.environ.get(QUERY_LOG_ENV) or None
+
+
+def input_digest(img: Image.Image, source: Optional[str] = None) -> str:
+    h = hashlib.sha256()
+    if source and os.path.isfile(source):
+        with open(source, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+    else:
+        h.update(f"{img.mode}:{img.size}".encode("utf-8"))
+        h.update(img.tobytes())
+    return h.hexdigest()
+
+
+def log_query(
+    img: Image.Image,
+    source: Optional[str],
+    op: str,
+    index_dir: str,
+    top_k: int,
+    filters: dict,
+    latency_s: float,
+    hits: List[dict],
+    path: Optional[str] = None,
+) -> None:
+    path = path or query_log_path()
+    if not path:
+        return
+    try:
+        digest = input_digest(img, source)
+        inputs_dir = os.environ.get(QUERY_INPUTS_ENV)
+        if source is None and inputs_dir:
+            os.makedirs(inputs_dir, exist_ok=True)
+            source = os.path.join(inputs_dir, f"{digest}.jpg")
+            if not os.path.exists(source):
+                img.convert("RGB").save(source, format="JPEG")
+        rec = {
+            "ts": time.time(),
+            "op": op,
+            "input_sha256": digest,
+            "input": os.path.abspath(source) if source else None,
+            "index_dir": os.path.abspath(index_dir),
+            "index_version": os.path.realpath(index_dir),
+            "top_k": int(top_k),
+            "filters": filters,
+            "latency_ms": round(latency_s * 1000.0, 3),
+            "result_ids": [h.get("id") for h in hits],
+            "result_scores": [round(float(h.get("score", 0.0)), 6) for h in hits],
+        }
+        line = json.dumps(rec, ensure_ascii=False) + "\n"
+        # Single appended write per record keeps lines whole across threads and processes
+        with _lock, open(path, "a") as f:
+            f.write(line)
+    except Exception as e:
+        warnings.warn(f"Could not write query log {path}: {e}")
+
+
+def read_query_log(path: str) -> List[dict]:
+    records: List[dict] = []
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                records.append(json.loads(line))
+    return records
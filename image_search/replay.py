@@ -0,0 +1,169 @@
+import json
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+from image_search.query_log import QUERY_LOG_ENV, read_query_log
+
+# Replays captured query logs against the in-process engine or the local worker
+# service at a chosen concurrency and arrival rate, and reports throughput,
+# latency percentiles and result drift between index versions.
+
+
+def _engine(target: str) -> Callable[..., List[dict]]:
+    if target == "inproc":
+        from image_search.query import search_image
+
+        return lambda image, index_dir, top_k, alpha, cascade: search_image(image, index_dir, top_k=top_k, alpha=alpha, cascade=cascade)
+    if target == "worker":
+        from image_search.worker import call_worker
+
+        return lambda image, index_dir, top_k, alpha, cascade: call_worker(
+            "search_image", image=image, index_dir=index_dir, top_k=top_k, alpha=alpha, cascade=cascade
+        )
+    raise ValueError("target must be 'inproc' or 'worker'")
+
+
+def run_load(
+    records: List[dict],
+    index_dir: str,
+    target: str = "inproc",
+    concurrency: int = 4,
+    rate: Optional[float] = None,
+    seed: int = 0,
+) -> Dict[str, object]:
+    # rate=None runs closed-loop (each worker thread sends back to back); a rate in
+    # queries/second runs open-loop with Poisson arrivals, and latency then includes
+    # the time a request waited for a free thread.
+    search = _engine(target)
+    rng = random.Random(seed)
+    arrivals: List[float] = []
+    t = 0.0
+    for _ in records:
+        arrivals.append(t)
+        if rate:
+            t += rng.expovariate(rate)
+
+    def run(rec: dict) -> List[dict]:
+        # Logged filters are replayed as captured, including the cascade shortlist size
+        filters = rec.get("filters") or {}
+        return search(rec["input"], index_dir, rec.get("top_k", 5), filters.get("alpha"), filters.get("cascade", 0))
+
+    # One untimed query loads the model and index (or starts the worker) before the
+    # clock starts; concurrent cold misses would each load the model
+    try:
+        run(records[0])
+    except Exception:
+        pass
+
+    latencies: List[Optional[float]] = [None] * len(records)
+    results: List[Optional[List[str]]] = [None] * len(records)
+    start = time.perf_counter()
+
+    def one(i: int) -> None:
+        rec = records[i]
+        scheduled = start + arrivals[i] if rate else time.perf_counter()
+        try:
+            hits = run(rec)
+            results[i] = [h.get("id") for h in hits]
+        except Exception:
+            return
+        latencies[i] = time.perf_counter() - scheduled
+
+    with ThreadPoolExecutor(max_workers=concurrency) as ex:
+        for i in range(len(records)):
+            if rate:
+                delay = start + arrivals[i] - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            ex.submit(one, i)
+    wall = time.perf_counter() - start
+
+    ok = np.array([x for x in latencies if x is not None]) * 1000.0
+    return {
+        "queries": len(records),
+        "errors": len(records) - len(ok),
+        "wall_s": wall,
+        "throughput_qps": len(ok) / wall if wall > 0 else 0.0,
+        "p50_ms": float(np.percentile(ok, 50)) if len(ok) else None,
+        "p99_ms": float(np.percentile(ok, 99)) if len(ok) else None,
+        "mean_ms": float(ok.mean()) if len(ok) else None,
+        "result_ids": results,
+    }
+
+
+def result_drift(a: List[Optional[List[str]]], b: List[Optional[List[str]]]) -> Dict[str, float]:
+    # Overlap@k and top-1 agreement over queries answered on both sides
+    overlaps: List[float] = []
+    top1: List[float] = []
+    for x, y in zip(a, b):
+        if not x or not y:
+            continue
+        k = max(len(x), len(y))
+        overlaps.append(len(set(x) & set(y)) / k)
+        top1.append(float(x[0] == y[0]))
+    return {
+        "compared": len(overlaps),
+        "mean_overlap_at_k": float(np.mean(overlaps)) if overlaps else float("nan"),
+        "top1_agreement": float(np.mean(top1)) if top1 else float("nan"),
+    }
+
+
+def replay(
+    log_path: str,
+    index_dir: Optional[str] = None,
+    compare_index_dir: Optional[str] = None,
+    target: str = "inproc",
+    concurrency: int = 4,
+    rate: Optional[float] = None,
+    limit: Optional[int] = None,
+) -> Dict[str, object]:
+    # Replayed queries must not be appended to the log being read
+    os.environ.pop(QUERY_LOG_ENV, None)
+    records = [r for r in read_query_log(log_path) if r.get("input") and os.path.isfile(r["input"])]
+    if limit:
+        records = records[:limit]
+    if not records:
+        raise RuntimeError("No replayable records (inputs missing); capture with IMAGE_SEARCH_QUERY_LOG_INPUTS set")
+    index_dir = index_dir or records[0]["index_dir"]
+
+    report: Dict[str, object] = {}
+    a = run_load(records, index_dir, target=target, concurrency=concurrency, rate=rate)
+    report[index_dir] = {k: v for k, v in a.items() if k != "result_ids"}
+    if compare_index_dir:
+        b = run_load(records, compare_index_dir, target=target, concurrency=concurrency, rate=rate)
+        report[compare_index_dir] = {k: v for k, v in b.items() if k != "result_ids"}
+        report["drift"] = result_drift(a["result_ids"], b["result_ids"])
+    else:
+        # Without a second index, drift is measured against what was served when logged
+        report["drift_vs_log"] = result_drift([r.get("result_ids") for r in records], a["result_ids"])
+    return report
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Replay a captured query log as load and compare index versions")
+    parser.add_argument("--log", required=True, help="JSONL written via IMAGE_SEARCH_QUERY_LOG")
+    parser.add_argument("--index_dir", default=None, help="Defaults to the index recorded in the log")
+    parser.add_argument("--compare_index_dir", default=None, help="Second index version to replay and diff against")
+    parser.add_argument("--target", choices=["inproc", "worker"], default="inproc")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--rate", type=float, default=None, help="Open-loop arrival rate in queries/s (Poisson); omit for closed loop")
+    parser.add_argument("--limit", type=int, default=None)
+    args = parser.parse_args()
+
+    report = replay(
+        args.log,
+        index_dir=args.index_dir,
+        compare_index_dir=args.compare_index_dir,
+        target=args.target,
+        concurrency=args.concurrency,
+        rate=args.rate,
+        limit=args.limit,
+    )
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,292 @@
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional
+
+# Thread budgets for torch (intra-op / inter-op), BLAS/OpenMP (numpy search),
+# faiss and HF tokenizers, chosen per platform and workload:
+#   build  - bulk embedding at index build time
+#   query  - one interactive query at a time
+#   batch  - many queries per call (backtests, bulk prediction)
+# BLAS/OpenMP read their thread counts from the environment when first loaded, so
+# configure_threads() must run before numpy, torch or faiss are imported; entry
+# modules call it at the top. Variables already set in the environment win.
+#
+# `python -m image_search.runtime calibrate` measures candidate thread counts on
+# this host and saves the best ones; later runs on the same host use them. Each
+# budget is swept on the kernel it controls: BLAS on the numpy search, faiss on a
+# flat faiss search, and torch intra-op then inter-op on image encoding.
+
+WORKLOADS = ("build", "query", "batch")
+PROFILE_ENV = "IMAGE_SEARCH_RUNTIME_PROFILE"
+DEFAULT_PROFILE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "image_search", "runtime_profile.json")
+
+BLAS_VARS = ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS")
+
+_active: Optional[Dict[str, object]] = None
+# BLAS variables the user had set before configure_threads filled in the rest
+_user_vars: set = set()
+
+
+def env_flag(name: str) -> bool:
+    # "0", "false", "no" and unset all mean off
+    return os.environ.get(name, "").strip().lower() in ("1", "true", "yes", "on")
+
+
+def cpu_count() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def default_profile(workload: str) -> Dict[str, object]:
+    if sys.platform == "darwin":
+        # Multi-threaded OpenMP/MKL alongside torch segfaults on macOS/Python 3.13
+        return {"intra_op": 1, "inter_op": 1, "blas": 1, "faiss": 1, "tokenizers_parallelism": False}
+    cores = cpu_count()
+    if workload == "query":
+        # Small per-query kernels stop scaling early and leave cores for other sessions
+        n = min(4, cores)
+        return {"intra_op": n, "inter_op": 1, "blas": n, "faiss": n, "tokenizers_parallelism": False}
+    if workload in ("build", "batch"):
+        return {"intra_op": cores, "inter_op": 1, "blas": cores, "faiss": cores, "tokenizers_parallelism": True}
+    raise ValueError(f"workload must be one of {WORKLOADS}")
+
+
+def profile_path() -> str:
+    return os.environ.get(PROFILE_ENV) or DEFAULT_PROFILE_PATH
+
+
+def load_saved_profile(workload: str) -> Optional[Dict[str, object]]:
+    path = profile_path()
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r") as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        return None
+    # Calibrations only apply to the host they were measured on
+    if saved.get("host") != platform.node() or saved.get("cpus") != cpu_count():
+        return None
+    return saved.get("profiles", {}).get(workload)
+
+
+def configure_threads(workload: str) -> Dict[str, object]:
+    global _active
+    if _active is not None:
+        return _active
+    profile = {**default_profile(workload), **(load_saved_profile(workload) or {})}
+    blas = str(profile["blas"])
+    _user_vars.update(var for var in BLAS_VARS if var in os.environ)
+    for var in BLAS_VARS:
+        os.environ.setdefault(var, blas)
+    os.environ.setdefault("TOKENIZERS_PARALLELISM", "true" if profile["tokenizers_parallelism"] else "false")
+    _active = {"workload": workload, **profile}
+    return _active
+
+
+def set_child_blas_threads(n: int) -> None:
+    # For processes started from here: BLAS variables the user set before
+    # configure_threads are kept, the ones it filled in are replaced
+    for var in BLAS_VARS:
+        if var not in _user_vars:
+            os.environ[var] = str(n)
+
+
+def apply_threads() -> None:
+    # Call after torch/faiss are imported; settings that are already fixed are left alone
+    profile = _active or configure_threads("query")
+    torch = sys.modules.get("torch")
+    if torch is not None:
+        torch.set_num_threads(int(profile["intra_op"]))
+        try:
+            torch.set_num_interop_threads(int(profile["inter_op"]))
+        except RuntimeError:
+            # Only settable once, before any inter-op parallel work has started
+            pass
+    faiss = sys.modules.get("faiss")
+    if faiss is not None:
+        # Profiles saved before faiss was calibrated separately share the BLAS count
+        faiss.omp_set_num_threads(int(profile.get("faiss", profile["blas"])))
+
+
+def peak_rss_mb() -> float:
+    import resource
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes on Linux
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+PROBE_KINDS = ("blas", "faiss", "encode")
+# Profile overrides (JSON) for a probe child process
+PROBE_ENV = "IMAGE_SEARCH_PROBE_PROFILE"
+
+
+def _probe(workload: str, kind: str, model_name: str, device: str, repeats: int) -> Optional[float]:
+    # Runs in a child process whose environment fixes the thread counts under test.
+    # Returns seconds per call, or None if the kernel is unavailable here.
+    configure_threads(workload)
+    import numpy as np
+    from PIL import Image
+
+    rng = np.random.default_rng(0)
+    n_queries = 1 if workload == "query" else 64
+    if kind in ("blas", "faiss"):
+        X = rng.standard_normal((100_000, 512)).astype("float32")
+        Q = rng.standard_normal((n_queries, 512)).astype("float32")
+        if kind == "blas":
+            from image_search.index_store import topk_inner_product
+
+            def run():
+                topk_inner_product(Q, X, 10)
+        else:
+            try:
+                import faiss  # type: ignore
+            except ImportError:
+                return None
+            apply_threads()
+            index = faiss.IndexFlatIP(X.shape[1])
+            index.add(X)
+
+            def run():
+                index.search(Q, 10)
+    else:
+        try:
+            from sentence_transformers import SentenceTransformer
+
+            model = SentenceTransformer(model_name, device=device)
+        except Exception:
+            # Model unavailable offline
+            return None
+        apply_threads()
+        batch = 1 if workload == "query" else 32
+        imgs = [Image.fromarray(rng.integers(0, 255, (224, 224, 3), dtype=np.uint8)) for _ in range(batch)]
+
+        def run():
+            model.encode(imgs, batch_size=batch, convert_to_numpy=True, show_progress_bar=False)
+    run()
+    t0 = time.perf_counter()
+    for _ in range(repeats):
+        run()
+    return (time.perf_counter() - t0) / repeats
+
+
+def _sweep(
+    workload: str,
+    kind: str,
+    knob: str,
+    values: List[int],
+    base: Dict[str, object],
+    model_name: str,
+    device: str,
+    repeats: int,
+    measurements: Dict[int, object],
+) -> Optional[int]:
+    # Times the probe with base[knob] set to each value; None if the probe cannot run
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    best_n, best_t = None, float("inf")
+    for n in values:
+        profile = {**base, knob: n}
+        env = dict(os.environ)
+        env.pop(PROFILE_ENV, None)
+        # BLAS reads its thread count from the environment when first loaded
+        for var in BLAS_VARS:
+            env[var] = str(profile["blas"])
+        env[PROBE_ENV] = json.dumps(profile)
+        env["PYTHONPATH"] = os.pathsep.join(p for p in (package_root, env.get("PYTHONPATH")) if p)
+        out = subprocess.run(
+            [sys.executable, "-m", "image_search.runtime", "_probe", "--workload", workload, "--kind", kind,
+             "--model", model_name, "--device", device, "--repeats", str(repeats)],
+            env=env, capture_output=True, text=True,
+        )
+        if out.returncode != 0:
+            measurements[n] = {"error": out.stderr.strip().splitlines()[-1:]}
+            continue
+        seconds = json.loads(out.stdout.strip().splitlines()[-1])
+        if seconds is None:
+            print(f"{workload:>6} {kind:<6} unavailable on this host; {knob} keeps {base[knob]}")
+            return None
+        measurements[n] = seconds
+        print(f"{workload:>6} {kind:<6} {knob}={n:<3} {seconds * 1000:.1f}ms")
+        # Prefer fewer threads unless more are at least 5% faster
+        if seconds < best_t * 0.95:
+            best_n, best_t = n, seconds
+    return best_n
+
+
+def calibrate(
+    workloads: List[str] = list(WORKLOADS),
+    model_name: str = "clip-ViT-B-32",
+    device: str = "cpu",
+    repeats: int = 3,
+) -> Dict[str, object]:
+    cores = cpu_count()
+    candidates = sorted({1, 2, 4, 8, 16, 32, cores} & set(range(1, cores + 1)))
+    # Inter-op threads only run independent torch ops side by side, so a few suffice
+    inter_candidates = sorted({1, 2, 4} & set(range(1, cores + 1)))
+    measurements: Dict[str, Dict[str, Dict[int, object]]] = {}
+    profiles: Dict[str, Dict[str, object]] = {}
+    for workload in workloads:
+        measurements[workload] = {k: {} for k in ("blas", "faiss", "intra_op", "inter_op")}
+        profile = default_profile(workload)
+        # Later sweeps run with the counts already chosen
+        for kind, knob, values in (
+            ("blas", "blas", candidates),
+            ("faiss", "faiss", candidates),
+            ("encode", "intra_op", candidates),
+            ("encode", "inter_op", inter_candidates),
+        ):
+            best = _sweep(workload, kind, knob, values, profile, model_name, device, repeats, measurements[workload][knob])
+            if best is not None:
+                profile[knob] = best
+        profiles[workload] = profile
+
+    # Workloads not calibrated in this run keep their previously saved profile
+    path = profile_path()
+    previous: Dict[str, object] = {}
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            previous = json.load(f)
+        if previous.get("host") != platform.node():
+            previous = {}
+    saved = {
+        "host": platform.node(),
+        "cpus": cores,
+        "platform": sys.platform,
+        "profiles": {**previous.get("profiles", {}), **profiles},
+        "measurements": {**previous.get("measurements", {}), **measurements},
+    }
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(saved, f, indent=2)
+    return saved
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Inspect or calibrate thread budgets for this host")
+    parser.add_argument("command", choices=["show", "calibrate", "_probe"], nargs="?", default="show")
+    parser.add_argument("--workload", choices=WORKLOADS, default=None)
+    parser.add_argument("--kind", choices=PROBE_KINDS, default="blas")
+    parser.add_argument("--model", default="clip-ViT-B-32")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.command == "_probe":
+        _active = {**default_profile(args.workload), **json.loads(os.environ.get(PROBE_ENV, "{}")), "workload": args.workload}
+        print(json.dumps(_probe(args.workload, args.kind, args.model, args.device, args.repeats)))
+    elif args.command == "calibrate":
+        saved = calibrate([args.workload] if args.workload else list(WORKLOADS), args.model, args.device, args.repeats)
+        print(json.dumps(saved["profiles"], indent=2))
+        print(f"Saved to {profile_path()}")
+    else:
+        for w in ([args.workload] if args.workload else WORKLOADS):
+            print(w, json.dumps({**default_profile(w), **(load_saved_profile(w) or {})}))
@@ -0,0 +1,142 @@
+import hashlib
+import heapq
+import json
+import os
+import re
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from image_search.runtime import env_flag
+
+# A sharded index directory holds shards.json plus one index_store directory per
+# shard under shards/. Queries fan out to every shard in parallel (threads over
+# the memory-mapped shards, or one local worker process per shard) and the
+# per-shard top-k lists are merged into a global top-k.
+
+SHARD_MAP_FILE = "shards.json"
+SHARD_BY = ("hash", "gender", "category")
+
+# Deployment knobs, read from the environment so callers of search_image and
+# search_topk do not need extra arguments
+DEFAULT_TIMEOUT = float(os.environ["IMAGE_SEARCH_SHARD_TIMEOUT"]) if os.environ.get("IMAGE_SEARCH_SHARD_TIMEOUT") else None
+DEFAULT_USE_WORKERS = env_flag("IMAGE_SEARCH_SHARD_WORKERS")
+
+# Errors that mark a shard as unavailable (timeouts, socket and worker failures);
+# anything else is a problem with the query itself and is raised
+SHARD_FAILURES = (concurrent.futures.TimeoutError, OSError, RuntimeError)
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_size = 0
+
+
+def is_sharded(index_dir: str) -> bool:
+    return os.path.exists(os.path.join(index_dir, SHARD_MAP_FILE))
+
+
+def shard_key(row: dict, shard_by: str, num_shards: int) -> str:
+    if shard_by == "hash":
+        h = int(hashlib.md5(row["id"].encode("utf-8")).hexdigest()[:8], 16)
+        return f"{h % num_shards:02d}"
+    if shard_by == "gender":
+        key = row.get("gender") or "unknown"
+    elif shard_by == "category":
+        key = f"{row.get('gender') or 'unknown'}_{row.get('category') or 'unknown'}"
+    else:
+        raise ValueError(f"shard_by must be one of {SHARD_BY}")
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", key)
+
+
+def partition_rows(meta: List[dict], shard_by: str, num_shards: int) -> Dict[str, List[int]]:
+    parts: Dict[str, List[int]] = {}
+    for i, row in enumerate(meta):
+        parts.setdefault(shard_key(row, shard_by, num_shards), []).append(i)
+    return dict(sorted(parts.items()))
+
+
+def write_shard_map(out_dir: str, shard_by: str, counts: Dict[str, int]) -> None:
+    with open(os.path.join(out_dir, SHARD_MAP_FILE), "w") as f:
+        json.dump({
+            "format": 1,
+            "shard_by": shard_by,
+            "shards": [{"name": name, "path": os.path.join("shards", name), "count": n} for name, n in counts.items()],
+        }, f)
+
+
+def load_shard_map(index_dir: str) -> List[Tuple[str, str]]:
+    real_dir = os.path.realpath(index_dir)
+    with open(os.path.join(real_dir, SHARD_MAP_FILE), "r") as f:
+        spec = json.load(f)
+    return [(s["name"], os.path.join(real_dir, s["path"])) for s in spec["shards"]]
+
+
+def shard_socket(shard_dir: str) -> str:
+    from image_search.worker import DEFAULT_SOCKET
+
+    # Keyed on the resolved shard path so a newly published index gets fresh workers
+    h = hashlib.sha1(os.path.realpath(shard_dir).encode("utf-8")).hexdigest()[:12]
+    return f"{os.path.splitext(DEFAULT_SOCKET)[0]}-shard-{h}.sock"
+
+
+def _search_local(q: np.ndarray, shard_dir: str, top_k: int, alpha: Optional[float]) -> List[List[dict]]:
+    from image_search.query import search_hits
+
+    return search_hits(q, shard_dir, top_k, alpha=alpha)
+
+
+def _search_remote(q: np.ndarray, shard_dir: str, top_k: int, alpha: Optional[float], timeout: Optional[float]) -> List[List[dict]]:
+    from image_search.worker import call_worker
+
+    return call_worker(
+        "search_vectors",
+        socket_path=shard_socket(shard_dir),
+        timeout=timeout,
+        index_dir=shard_dir,
+        vectors=q.tolist(),
+        top_k=top_k,
+        alpha=alpha,
+    )
+
+
+def search_shards(
+    q: np.ndarray,
+    index_dir: str,
+    top_k: int,
+    alpha: Optional[float] = None,
+    timeout: Optional[float] = DEFAULT_TIMEOUT,
+    use_workers: bool = DEFAULT_USE_WORKERS,
+) -> Tuple[List[List[dict]], dict]:
+    global _executor, _executor_size
+    shards = load_shard_map(index_dir)
+    if _executor is None or _executor_size < len(shards):
+        _executor_size = max(len(shards), 4)
+        _executor = ThreadPoolExecutor(max_workers=_executor_size, thread_name_prefix="shard")
+
+    futures = {}
+    for name, shard_dir in shards:
+        if use_workers:
+            fut = _executor.submit(_search_remote, q, shard_dir, top_k, alpha, timeout)
+        else:
+            fut = _executor.submit(_search_local, q, shard_dir, top_k, alpha)
+        futures[fut] = name
+    done, not_done = wait(futures, timeout=timeout)
+
+    failed: List[str] = sorted(futures[f] for f in not_done)
+    per_query: List[List[dict]] = [[] for _ in range(q.shape[0])]
+    for fut in done:
+        name = futures[fut]
+        try:
+            shard_hits = fut.result()
+        except SHARD_FAILURES:
+            failed.append(name)
+            continue
+        for qi, hits in enumerate(shard_hits):
+            per_query[qi].extend({**h, "shard": name} for h in hits)
+    if len(failed) == len(shards):
+        raise RuntimeError(f"No shard answered; failed shards: {', '.join(sorted(failed))}")
+
+    merged = [heapq.nlargest(top_k, hits, key=lambda h: h["score"]) for hits in per_query]
+    info = {"partial": bool(failed), "failed_shards": sorted(failed), "shards": len(shards)}
+    return merged, info
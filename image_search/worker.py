@@ -0,0 +1,223 @@
+import json
+import os
+import socket
+import socketserver
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+# Persistent local worker: keeps the model and loaded indexes warm in one process
+# and serves CLI invocations over a Unix socket, one JSON line per request/response.
+# Sockets live in a directory only the current user can enter ($XDG_RUNTIME_DIR or
+# a 0700 directory under the temp dir), so no other user can bind the path first
+# and answer queries in the worker's place.
+
+
+def _socket_dir() -> str:
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return os.path.join(runtime_dir, "image_search")
+    return os.path.join(tempfile.gettempdir(), f"image_search-{os.getuid()}")
+
+
+DEFAULT_SOCKET = os.environ.get("IMAGE_SEARCH_SOCKET", os.path.join(_socket_dir(), "worker.sock"))
+DEFAULT_IDLE_TIMEOUT = 15 * 60
+
+
+def _search_image(image: str, index_dir: str, top_k: int = 5, model_name: str = "clip-ViT-B-32", device: str = "cpu", alpha: Optional[float] = None, cascade: int = 0):
+    from image_search.query import search_image
+
+    return search_image(image, index_dir, top_k=top_k, model_name=model_name, device=device, alpha=alpha, cascade=cascade)
+
+
+def _search_topk(
+    image: str,
+    index_dir: str,
+    top_k: int = 5,
+    model_name: str = "clip-ViT-B-32",
+    device: str = "cpu",
+    alpha: Optional[float] = None,
+    return_info: bool = False,
+):
+    from image_search.query_avg import search_topk
+
+    return search_topk(image, index_dir, top_k=top_k, model_name=model_name, device=device, alpha=alpha, return_info=return_info)
+
+
+def _search_vectors(index_dir: str, vectors: List[List[float]], top_k: int = 5, alpha: Optional[float] = None):
+    import numpy as np
+
+    from image_search.query import search_hits
+
+    return search_hits(np.asarray(vectors, dtype="float32"), index_dir, top_k, alpha=alpha)
+
+
+OPS: Dict[str, Callable[..., Any]] = {
+    "ping": lambda: "pong",
+    "search_image": _search_image,
+    "search_topk": _search_topk,
+    # Used by the shard coordinator: one worker process per shard directory
+    "search_vectors": _search_vectors,
+}
+
+# Exceptions re-raised with their own type on the client side
+_ERRORS = {"FileNotFoundError": FileNotFoundError, "ValueError": ValueError}
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            req = json.loads(line)
+            op = req.get("op")
+            if op == "shutdown":
+                self.server.stop_requested = True
+                resp = {"ok": True, "result": None}
+            elif op not in OPS:
+                raise ValueError(f"Unknown op: {op}")
+            else:
+                resp = {"ok": True, "result": OPS[op](**req.get("args", {}))}
+        except Exception as e:
+            resp = {"ok": False, "error": str(e), "type": type(e).__name__}
+        self.wfile.write((json.dumps(resp, ensure_ascii=False) + "\n").encode("utf-8"))
+
+
+class _Server(socketserver.UnixStreamServer):
+    stop_requested = False
+
+    def handle_timeout(self):
+        self.stop_requested = True
+
+
+def _check_socket_dir(socket_path: str) -> None:
+    # Creates the socket's directory if needed and refuses one that another user
+    # owns or can write to, where a foreign listener could be waiting
+    path = os.path.dirname(os.path.abspath(socket_path))
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise RuntimeError(f"Socket directory {path} must be a directory owned by the current user with mode 0700")
+
+
+def _connect(socket_path: str, timeout: Optional[float] = None) -> socket.socket:
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(socket_path)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def serve(socket_path: str = DEFAULT_SOCKET, idle_timeout: float = DEFAULT_IDLE_TIMEOUT) -> None:
+    _check_socket_dir(socket_path)
+    if os.path.exists(socket_path):
+        try:
+            _connect(socket_path, timeout=1.0).close()
+            # Another worker already owns the socket
+            return
+        except OSError:
+            os.remove(socket_path)
+    server = _Server(socket_path, _Handler)
+    # Requests are handled one at a time so the model is never used concurrently;
+    # the server exits after idle_timeout seconds without a request.
+    server.timeout = idle_timeout
+    try:
+        while not server.stop_requested:
+            server.handle_request()
+    finally:
+        server.server_close()
+        try:
+            os.remove(socket_path)
+        except OSError:
+            pass
+
+
+def _spawn(socket_path: str, idle_timeout: float) -> subprocess.Popen:
+    log_path = os.path.splitext(socket_path)[0] + ".log"
+    # Make the package importable regardless of the caller's cwd
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(p for p in (package_root, env.get("PYTHONPATH")) if p)
+    with open(log_path, "ab") as log:
+        return subprocess.Popen(
+            [sys.executable, "-m", "image_search.worker", "--socket", socket_path, "--idle_timeout", str(idle_timeout)],
+            stdin=subprocess.DEVNULL,
+            stdout=log,
+            stderr=log,
+            env=env,
+            start_new_session=True,
+        )
+
+
+def call_worker(
+    op: str,
+    socket_path: str = DEFAULT_SOCKET,
+    spawn: bool = True,
+    startup_timeout: float = 120.0,
+    idle_timeout: float = DEFAULT_IDLE_TIMEOUT,
+    timeout: Optional[float] = None,
+    **args,
+):
+    # The worker has its own cwd, so paths are resolved here
+    for key in ("image", "index_dir"):
+        if isinstance(args.get(key), str):
+            args[key] = os.path.abspath(args[key])
+    _check_socket_dir(socket_path)
+    try:
+        sock = _connect(socket_path)
+    except OSError:
+        if not spawn:
+            raise
+        proc = _spawn(socket_path, idle_timeout)
+        deadline = time.monotonic() + startup_timeout
+        while True:
+            try:
+                sock = _connect(socket_path)
+                break
+            except OSError:
+                # An early exit is fine only if another worker took the socket meanwhile
+                exited = proc.poll() is not None
+                if exited or time.monotonic() > deadline:
+                    try:
+                        sock = _connect(socket_path)
+                        break
+                    except OSError:
+                        reason = "exited" if exited else f"did not start within {startup_timeout}s"
+                        raise RuntimeError(f"Worker {reason}; see {os.path.splitext(socket_path)[0]}.log")
+                time.sleep(0.05)
+    with sock:
+        sock.settimeout(timeout)
+        sock.sendall((json.dumps({"op": op, "args": args}) + "\n").encode("utf-8"))
+        with sock.makefile("rb") as f:
+            line = f.readline()
+    if not line:
+        raise RuntimeError("Worker closed the connection without a response")
+    resp = json.loads(line)
+    if not resp.get("ok"):
+        raise _ERRORS.get(resp.get("type"), RuntimeError)(resp.get("error"))
+    return resp.get("result")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Persistent search worker serving CLI queries over a Unix socket")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET)
+    parser.add_argument("--idle_timeout", type=float, default=DEFAULT_IDLE_TIMEOUT, help="Exit after this many idle seconds")
+    parser.add_argument("--stop", action="store_true", help="Ask a running worker to exit")
+    args = parser.parse_args()
+
+    if args.stop:
+        try:
+            call_worker("shutdown", socket_path=args.socket, spawn=False)
+        except OSError:
+            print("No worker running")
+    else:
+        serve(args.socket, idle_timeout=args.idle_timeout)
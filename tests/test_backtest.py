@@ -0,0 +1,79 @@
+import numpy as np
+
+from image_search.backtest import neighbours, product_groups, product_targets, row_amounts, score_predictions
+from image_search.query_avg import average_amount_sold
+
+
+def _unit(rows):
+    X = np.asarray(rows, dtype="float32")
+    return X / np.linalg.norm(X, axis=1, keepdims=True)
+
+
+def test_product_groups_join_rows_sharing_any_id():
+    meta = [
+        {"id": "A", "ids": ["A", "B"]},
+        {"id": "B", "ids": ["B"]},
+        {"id": "C", "ids": ["C"]},
+        # Linked to row 0 only through B
+        {"id": "D", "ids": ["D", "B"]},
+        # Rows without ids fall back to their own id
+        {"id": "E"},
+    ]
+    groups = product_groups(meta)
+    assert groups[0] == groups[1] == groups[3]
+    assert len({groups[0], groups[2], groups[4]}) == 3
+
+
+def test_neighbours_skip_rows_of_the_same_product():
+    # Rows 1 and 3 share product B with the collapsed row 0 and are its closest
+    # vectors, yet must never be predicted from it
+    meta = [
+        {"id": "A", "ids": ["A", "B"]},
+        {"id": "B", "ids": ["B"]},
+        {"id": "C", "ids": ["C"]},
+        {"id": "D", "ids": ["D", "B"]},
+        {"id": "E", "ids": ["E"]},
+    ]
+    X = _unit([[1.0, 0.0, 0.0], [1.0, 0.01, 0.0], [1.0, 0.5, 0.0], [1.0, 0.0, 0.02], [0.0, 0.0, 1.0]])
+    groups = product_groups(meta)
+    scores, idxs = neighbours(X, X, groups, k=2, query_block=2)
+    assert idxs[0].tolist() == [2, 4]
+    assert idxs[2].tolist()[0] in (0, 1, 3)
+    for q in range(len(meta)):
+        kept = idxs[q][idxs[q] >= 0]
+        assert not np.any(groups[kept] == groups[q])
+        assert np.all(np.diff(scores[q][np.isfinite(scores[q])]) <= 0)
+
+
+def test_neighbours_pad_when_too_few_other_products():
+    meta = [{"id": "A", "ids": ["A", "B"]}, {"id": "B", "ids": ["B"]}, {"id": "C", "ids": ["C"]}]
+    X = _unit([[1.0, 0.0], [1.0, 0.1], [0.0, 1.0]])
+    scores, idxs = neighbours(X, X, product_groups(meta), k=2)
+    assert idxs[0].tolist() == [2, -1]
+    assert np.isneginf(scores[0, 1])
+
+
+def test_collapsed_rows_score_like_average_amount_sold():
+    meta = [
+        {"id": "P0", "ids": ["P0", "P30"], "amount_sold": 1439,
+         "members": [{"id": "P0", "amount_sold": 1439}, {"id": "P30", "amount_sold": 1696}]},
+        {"id": "P1", "ids": ["P1"], "amount_sold": 100},
+        {"id": "P2", "ids": ["P2"]},
+    ]
+    assert average_amount_sold(meta[:1]) == 1567.5
+
+    row_sums, row_counts = row_amounts(meta)
+    target_rows, y, cat_keys = product_targets(meta)
+    # One target per product with amount_sold; P2 has none
+    assert target_rows.tolist() == [0, 0, 1]
+    # Row 1 predicted from rows 0 and 2; row 0 from row 1
+    idxs = np.array([[1, -1], [0, 2], [1, 0]])
+    scores = np.array([[0.9, -np.inf], [0.9, 0.8], [0.9, 0.5]], dtype="float32")
+    categories = np.zeros(len(y), dtype="int64")
+    rows = score_predictions(scores, idxs, row_sums, row_counts, target_rows, y, categories, [":"], ks=[2], weightings=["uniform"])
+    overall = next(r for r in rows if r["category"] == "ALL")
+    # Row 1's prediction equals the live predictor on the same neighbours
+    pred_row1 = average_amount_sold([meta[0], meta[2]])
+    expected = (abs(100 - 1439) + abs(100 - 1696) + abs(pred_row1 - 100)) / 3
+    assert overall["n"] == 3
+    assert np.isclose(overall["mae"], expected)
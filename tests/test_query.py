@@ -0,0 +1,36 @@
+import os
+
+import numpy as np
+
+from image_search.query import _fused_scores, search_fused
+
+
+def _unit(X):
+    return (X / np.linalg.norm(X, axis=1, keepdims=True)).astype("float32")
+
+
+def _factored(rng, n=40, d=16):
+    return _unit(rng.standard_normal((n, d))), _unit(rng.standard_normal((n, d)))
+
+
+def test_fused_scores_match_explicitly_fused_matrix():
+    rng = np.random.default_rng(0)
+    X_img, X_txt = _factored(rng)
+    q = _unit(rng.standard_normal((1, 16)))[0]
+    for a in (0.0, 0.3, 0.7, 1.0):
+        fused = _unit(a * X_img + (1.0 - a) * X_txt)
+        np.testing.assert_allclose(_fused_scores(q, X_img, X_txt, a), fused @ q, rtol=1e-5, atol=1e-5)
+
+
+def test_search_fused_ranks_like_explicitly_fused_matrix(tmp_path):
+    rng = np.random.default_rng(1)
+    X_img, X_txt = _factored(rng)
+    np.save(os.path.join(tmp_path, "image_vectors.npy"), X_img)
+    np.save(os.path.join(tmp_path, "text_vectors.npy"), X_txt)
+    Q = _unit(rng.standard_normal((3, 16)))
+    for a in (0.0, 0.4, 1.0):
+        fused = _unit(a * X_img + (1.0 - a) * X_txt)
+        expected = np.argsort(-(Q @ fused.T), axis=1)[:, :5]
+        scores, idxs = search_fused(Q, str(tmp_path), top_k=5, alpha=a)
+        np.testing.assert_array_equal(idxs, expected)
+        np.testing.assert_allclose(scores, np.take_along_axis(Q @ fused.T, expected, axis=1), rtol=1e-5, atol=1e-5)